@@ -1,3 +1,4 @@
 from callbacks.animating import Plot4D, SliceSequencePlot, SliceVolumePlot
 from callbacks.plotting import Plot3D, SlicePlot, Plot3DDistance
-from callbacks.saving import EnhancedModelCheckpoint, SavePredictedSequence
+from callbacks.saving import EnhancedModelCheckpoint, SavePredictedSequence, \
+                             StreamPredictionWriter
@@ -1,4 +1,3 @@
-import h5py
 import torch
 
 from pathlib import Path
@@ -13,17 +12,12 @@ class EnhancedCallback(Callback):
     def __init__(self):
         super(EnhancedCallback, self).__init__()
 
-    def get_voxinfo(self, fname):
+    def get_voxinfo(self, dataset, iseq):
         # Get additionnal informations on voxel grid
         # As all info are the same for all frames of input, predictions and 
         # annotations, we extract it separately to not open the file repeatedly
-        hdf = h5py.File(fname, 'r')
-        origin = hdf["VolumeGeometry"]["origin"][()]
-        directions = hdf["VolumeGeometry"]["directions"][()]
-        spacing = hdf["VolumeGeometry"]["resolution"][()]
-        hdf.close()
-        # Same order as required for VoxelGrid
-        return origin, directions, spacing
+        # Dataset already knows where its files are, don't look for them again
+        return dataset.get_voxinfo(iseq)
 
     def resolve_dirpath(self, trainer, category):
         """ Solve saving directory if not default """
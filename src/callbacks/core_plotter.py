@@ -42,7 +42,7 @@ class Plotter(EnhancedCallback):
         for iseq in range(dataset.nb_sequences):
             inp, tg = dataset.get_sequence(iseq)
             # Convert everything to `VoxelGrid`
-            voxinfo = self.get_voxinfo(dataset.get_path(iseq))
+            voxinfo = self.get_voxinfo(dataset, iseq)
             vin = self.t2v(inp, voxinfo)
             nbf = len(vin)
             # First class is background, we don't plot it
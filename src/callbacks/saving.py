@@ -1,4 +1,5 @@
 import h5py
+import torch
 
 from pathlib import Path
 from pytorch_lightning.callbacks import ModelCheckpoint
@@ -52,8 +53,8 @@ class SavePredictedSequence(EnhancedCallback):
     def setup(self, trainer, pl_module, stage):
         self.resolve_dirpath(trainer, "predictions")
 
-    def add_voxinfo(self, fname, hdf):
-        origin, directions, spacing = self.get_voxinfo(fname)
+    def add_voxinfo(self, dataset, iseq, hdf):
+        origin, directions, spacing = self.get_voxinfo(dataset, iseq)
         info = hdf.create_group("/VolumeGeometry")
         info.create_dataset("origin", data=origin)
         info.create_dataset("directions", data=directions)
@@ -72,7 +73,7 @@ class SavePredictedSequence(EnhancedCallback):
             tg, pred = self.rm_background(dataset, tg, preds[prev_nbf:nbf + prev_nbf])
             fname = dataset.get_path(iseq)
             hdf = h5py.File(self.dirpath.joinpath(fname.name), 'w')
-            self.add_voxinfo(fname, hdf)
+            self.add_voxinfo(dataset, iseq, hdf)
             # Also save input/target since they're cropped
             hin, htg = hdf.create_group("/Input"), hdf.create_group("/Target")
             hpred = hdf.create_group("/Prediction")
@@ -92,3 +93,52 @@ class SavePredictedSequence(EnhancedCallback):
                     htg.create_dataset(f"vol{f + 1:02d}", data=ftg)
             prev_nbf += nbf
             hdf.close()
+
+
+class StreamPredictionWriter(EnhancedCallback):
+    """
+    Write predictions of streamed batches (see `data.datasets.HDFStreamDataset`)
+    as they come, in the same layout as `SavePredictedSequence`, so nothing
+    is kept in memory. Use it with `return_predictions=False`.
+    """
+    def __init__(self, dirpath=None):
+        self.dirpath = dirpath
+        self._started = set() # Files written during this run
+
+    def setup(self, trainer, pl_module, stage):
+        self.resolve_dirpath(trainer, "predictions")
+
+    def on_predict_start(self, trainer, pl_module):
+        self._started = set()
+
+    @staticmethod
+    def _foreground(volumes, i):
+        # (C, W, H, D) of item `i` without background, from a tensor or `TensorList`
+        if isinstance(volumes, list):
+            return torch.cat([ v[i, 1:] for v in volumes ]).cpu()
+        return volumes[i, 1:].cpu()
+
+    def on_predict_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=0):
+        preds, meta = outputs
+        inputs, targets = batch[0], (batch[1] if len(batch) == 3 else None)
+        for i, m in enumerate(meta):
+            fname = self.dirpath.joinpath(m["fname"])
+            with h5py.File(fname, 'a' if fname in self._started else 'w') as hdf:
+                if fname not in self._started:
+                    info = hdf.create_group("/VolumeGeometry")
+                    for k in ("origin", "directions", "resolution"):
+                        info.create_dataset(k, data=m[k])
+                    self._started.add(fname)
+                f = m["iframe"] + 1
+                hdf.require_group("/Input").create_dataset(f"vol{f:02d}",
+                                                           data=inputs[i].squeeze().cpu().numpy())
+                groups = [ ("/Prediction", self._foreground(preds, i)) ]
+                if targets is not None:
+                    groups.append(("/Target", self._foreground(targets, i)))
+                for name, vol in groups:
+                    group, vol = hdf.require_group(name), vol.squeeze().numpy()
+                    if vol.ndim == 4: # Multi class setting
+                        group.create_dataset(f"anterior-{f:02d}", data=vol[0])
+                        group.create_dataset(f"posterior-{f:02d}", data=vol[1])
+                    else:
+                        group.create_dataset(f"vol{f:02d}", data=vol)
@@ -0,0 +1,198 @@
+"""
+Training augmentations of `data.transforms.augmentations` applied to whole
+batches at once, see `BatchAugmentation`.
+"""
+
+import math
+import torch
+import torch.nn.functional as F
+
+from utils import TensorList
+
+
+
+def _uniform(low, high, shape, device):
+    return low + (high - low) * torch.rand(shape, device=device)
+
+def _rotations(angles):
+    # (B, 3) angles around each axis to (B, 3, 3) matrices, Rz @ Ry @ Rx as MONAI
+    cos, sin = angles.cos(), angles.sin()
+    one, zero = torch.ones_like(angles[:,0]), torch.zeros_like(angles[:,0])
+    def matrix(*rows):
+        return torch.stack([ torch.stack(r, dim=-1) for r in rows ], dim=-2)
+    rx = matrix((one, zero, zero), (zero, cos[:,0], -sin[:,0]), (zero, sin[:,0], cos[:,0]))
+    ry = matrix((cos[:,1], zero, sin[:,1]), (zero, one, zero), (-sin[:,1], zero, cos[:,1]))
+    rz = matrix((cos[:,2], -sin[:,2], zero), (sin[:,2], cos[:,2], zero), (zero, zero, one))
+    return rz @ ry @ rx
+
+def _centered_grid(spatial_size, device):
+    # (W, H, D, 3) voxel coordinates, origin at the center of the volume
+    axes = [ torch.arange(n, device=device, dtype=torch.float32) - (n - 1) / 2 for n in spatial_size ]
+    return torch.stack(torch.meshgrid(*axes, indexing="ij"), dim=-1)
+
+def _resample(volumes, coords):
+    # Bilinear sampling of (B, C, W, H, D) `volumes` at (B, W, H, D, 3) centered voxel `coords`
+    half = torch.tensor([ (n - 1) / 2 for n in volumes.shape[2:] ], device=coords.device)
+    # `grid_sample` wants (x, y, z) indexing the last, middle and first dimension
+    grid = (coords / half.clamp(min=0.5)).flip(-1)
+    return F.grid_sample(volumes, grid.to(volumes.dtype), mode="bilinear",
+                         padding_mode="border", align_corners=True)
+
+def _leaves(targets):
+    # Tensors of (nested) lists of targets, as `ListOutputModule` gets them
+    if isinstance(targets, torch.Tensor):
+        return [ targets ]
+    return [ t for elt in targets for t in _leaves(elt) ]
+
+def _rebuild(targets, leaves):
+    # Same nesting as `targets`, with `leaves` (an iterator) in place of its tensors
+    if isinstance(targets, torch.Tensor):
+        return next(leaves)
+    elts = [ _rebuild(elt, leaves) for elt in targets ]
+    return TensorList(*elts) if isinstance(targets, TensorList) else elts
+
+
+class BatchAugmentation:
+    """
+    Random transforms and probabilities of `data.transforms.augmentations`
+    (MONAI's defaults), drawn for each sample of (B, C, W, H, D) batches:
+    rotation and flip of inputs and targets, Gaussian noise, grid distortion
+    and elastic deformation of inputs. All moves of a batch are composed into
+    one sampling grid, so inputs are resampled once and targets once. Run it
+    where batches are, e.g. on the training device.
+    Unlike MONAI, noise is added after moves and outside voxels are always
+    the border's. On some axes shorter than `num_cells` squared, MONAI's
+    distortion cells don't cover the whole axis and leave the last voxels at
+    the first one's coordinate, here the last cell stretches to the border.
+    """
+    def __init__(self, rotate_range=5, rotate_prob=0.1, flip_prob=0.1,
+                 noise_std=0.1, noise_prob=0.1,
+                 num_cells=5, distort_limit=(-0.03, 0.03), distort_prob=0.1,
+                 sigma_range=(5, 7), magnitude_range=(50, 150), elastic_prob=0.1):
+        self.rotate_range, self.rotate_prob = rotate_range, rotate_prob
+        self.flip_prob = flip_prob
+        self.noise_std, self.noise_prob = noise_std, noise_prob
+        self.num_cells, self.distort_limit, self.distort_prob = num_cells, distort_limit, distort_prob
+        self.sigma_range, self.magnitude_range = sigma_range, magnitude_range
+        self.elastic_prob = elastic_prob
+
+    def _draw(self, batch_size, device):
+        drawn = {k: torch.rand(batch_size, device=device) < p
+                 for k, p in (("rotate", self.rotate_prob), ("flip", self.flip_prob),
+                              ("noise", self.noise_prob), ("distort", self.distort_prob),
+                              ("elastic", self.elastic_prob))}
+        # Flip one random axis, as `RandAxisFlip`
+        drawn["axis"] = torch.randint(3, (batch_size,), device=device)
+        return drawn
+
+    def affines(self, rotate, flip, axes):
+        """ (B, 3, 3) rotation then flip of each sample, identity when not drawn """
+        device = rotate.device
+        angles = _uniform(-self.rotate_range, self.rotate_range, (len(rotate), 3), device)
+        matrices = _rotations(angles * rotate.unsqueeze(1))
+        signs = torch.ones(len(flip), 3, device=device)
+        signs[flip, axes[flip]] = -1
+        return matrices * signs.unsqueeze(1)
+
+    def distortions(self, spatial_size, batch_size, device):
+        """ Per axis (B, size) tables of coordinates moved by `RandGridDistortion` """
+        tables = []
+        for n in spatial_size:
+            cell = max(n // self.num_cells, 1)
+            # One more cell than asked for, over what's left of the axis
+            steps = 1 + _uniform(*self.distort_limit, (batch_size, self.num_cells + 1), device)
+            knots = F.pad(torch.cumsum(cell * steps, dim=1), (1, 0))
+            index = torch.arange(n, device=device)
+            k = (index // cell).clamp(max=self.num_cells)
+            length = torch.where(k < self.num_cells, cell, n - self.num_cells * cell)
+            # Cells end where distorted, but one that doesn't fit ends at the border
+            ends = torch.where(length == cell, knots[:,k + 1], torch.tensor(float(n), device=device))
+            # Each cell spans its voxels linearly, as `torch.linspace`
+            t = (index - k * cell) / (length - 1).clamp(min=1)
+            table = knots[:,k] + (ends - knots[:,k]) * t
+            tables.append(table - (n - 1) / 2)
+        return tables
+
+    def offsets(self, spatial_size, batch_size, device):
+        """ (B, W, H, D, 3) smoothed random offsets of `Rand3DElastic`, in voxels """
+        sigmas = _uniform(*self.sigma_range, (batch_size,), device)
+        magnitudes = _uniform(*self.magnitude_range, (batch_size,), device)
+        offsets = _uniform(-1, 1, (3 * batch_size, *spatial_size), device)
+        # Gaussian filter cut at 3 sigmas, one per sample, as products of spectra.
+        # Zeros padding on one side is enough for circular convolutions not to wrap
+        radius = math.ceil(3 * self.sigma_range[1])
+        support = torch.arange(-radius, radius + 1, device=device)
+        kernels = torch.exp(-0.5 * (support / sigmas.unsqueeze(1)) ** 2)
+        kernels = (kernels / kernels.sum(dim=1, keepdim=True)).repeat_interleave(3, dim=0)
+        padded = [ n + radius for n in spatial_size ]
+        spectrum = torch.fft.rfftn(offsets, s=padded, dim=(1, 2, 3))
+        for axis, n in enumerate(padded):
+            circular = torch.zeros(len(kernels), n, device=device)
+            circular[:,support % n] = kernels
+            fft = torch.fft.rfft if axis == 2 else torch.fft.fft
+            shape = [ -1, 1, 1, 1 ]
+            shape[axis + 1] = spectrum.shape[axis + 1]
+            spectrum = spectrum * fft(circular, dim=1).view(shape)
+        offsets = torch.fft.irfftn(spectrum, s=padded, dim=(1, 2, 3))
+        offsets = offsets[:,:spatial_size[0],:spatial_size[1],:spatial_size[2]]
+        offsets = offsets.view(batch_size, 3, *spatial_size) * magnitudes.view(-1, 1, 1, 1, 1)
+        return offsets.movedim(1, -1)
+
+    def _distort(self, coords, tables):
+        # Piecewise linear maps of `tables` at (B, W, H, D, 3) `coords`, slope 1 outside
+        moved = []
+        for axis, table in enumerate(tables):
+            n = table.shape[1]
+            index = coords[...,axis] + (n - 1) / 2
+            inside = index.clamp(0, n - 1)
+            # Linear interpolation in the table, seen as a (1, n) image
+            x = inside.flatten(1) * (2 / max(n - 1, 1)) - 1
+            grid = torch.stack([ x, torch.zeros_like(x) ], dim=-1).unsqueeze(1)
+            values = F.grid_sample(table.view(-1, 1, 1, n), grid, mode="bilinear",
+                                   align_corners=True)
+            moved.append(values.view_as(index) + index - inside)
+        return torch.stack(moved, dim=-1)
+
+    def __call__(self, inputs, targets):
+        """ Augment (B, C, W, H, D) `inputs` and `targets` (a tensor or lists of tensors) """
+        batch_size, spatial_size, device = len(inputs), inputs.shape[2:], inputs.device
+        drawn = self._draw(batch_size, device)
+        moved = drawn["rotate"] | drawn["flip"]
+        affines = self.affines(drawn["rotate"], drawn["flip"], drawn["axis"])
+        grid = _centered_grid(spatial_size, device)
+        if moved.any():
+            leaves = [ t.clone() for t in _leaves(targets) ]
+            # Only flipped targets stay exact, don't resample them
+            flipped = drawn["flip"] & ~drawn["rotate"]
+            for axis in range(3):
+                which = flipped & (drawn["axis"] == axis)
+                for t in leaves:
+                    t[which] = t[which].flip(axis + 2)
+            if drawn["rotate"].any():
+                which = drawn["rotate"].nonzero().squeeze(1)
+                coords = torch.einsum("bij,whdj->bwhdi", affines[which], grid)
+                stacked = torch.cat([ t[which] for t in leaves ], dim=1)
+                sampled = _resample(stacked.to(torch.float32), coords)
+                for t, s in zip(leaves, sampled.split([ t.shape[1] for t in leaves ], dim=1)):
+                    t[which] = s.to(t.dtype)
+            targets = _rebuild(targets, iter(leaves))
+        deformed = moved | drawn["distort"] | drawn["elastic"]
+        inputs = inputs.clone()
+        if deformed.any():
+            # Last transform moves coordinates first: elastic, grid distortion then affine
+            which = deformed.nonzero().squeeze(1)
+            coords = grid.expand(len(which), *grid.shape).clone()
+            elastic = drawn["elastic"][which]
+            if elastic.any():
+                coords[elastic] += self.offsets(spatial_size, int(elastic.sum()), device)
+            distort = drawn["distort"][which]
+            if distort.any():
+                tables = self.distortions(spatial_size, int(distort.sum()), device)
+                coords[distort] = self._distort(coords[distort], tables)
+            coords = torch.einsum("bij,bwhdj->bwhdi", affines[which], coords)
+            inputs[which] = _resample(inputs[which].to(torch.float32), coords).to(inputs.dtype)
+        noisy = drawn["noise"]
+        if noisy.any():
+            stds = _uniform(0, self.noise_std, (int(noisy.sum()),), device)
+            inputs[noisy] += stds.view(-1, 1, 1, 1, 1) * torch.randn_like(inputs[noisy])
+        return inputs, targets
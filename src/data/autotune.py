@@ -0,0 +1,197 @@
+"""
+Find the DataLoader settings giving the most samples per second on this
+machine for a training configuration. Run as `python -m data.autotune`
+(from `src/`) and merge the fragment it writes in your configuration.
+"""
+
+import click as cli
+import multiprocessing as mp
+import os
+import resource
+import threading
+import time
+import yaml
+
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from pathlib import Path
+
+from data.cache import to_bytes
+from data.loaders import load_data
+from utils import InclusiveLoader, rec_update
+
+
+
+def _proc_stats():
+    # {pid: (parent pid, RSS in pages)} of all processes, from /proc
+    stats = {}
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat", 'r') as fd:
+                # Command name can hold spaces, fields start after its ')'
+                fields = fd.read().rsplit(')', 1)[1].split()
+        except OSError: # Exited meanwhile
+            continue
+        stats[int(entry.name)] = (int(fields[1]), int(fields[21]))
+    return stats
+
+def tree_rss(pid=None):
+    """ RSS of process `pid` (current one if None) and all its descendants, in bytes """
+    pid = os.getpid() if pid is None else pid
+    if not os.path.isdir("/proc"): # No way to see children, own peak is all we have
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    stats = _proc_stats()
+    tree, total = [ pid ], 0
+    while tree:
+        current = tree.pop()
+        total += stats.get(current, (None, 0))[1]
+        tree += [ p for p, (ppid, _) in stats.items() if ppid == current ]
+    return total * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakRSS(threading.Thread):
+    """ Highest `tree_rss` seen, polled every `interval` seconds until `stop` """
+    def __init__(self, interval=0.2):
+        super(PeakRSS, self).__init__(daemon=True)
+        self.interval, self.peak = interval, 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, tree_rss())
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return max(self.peak, tree_rss())
+
+
+def _batch_size(batch):
+    # Dense batches are tuples, `CompactBatch` has a length
+    return len(batch[0]) if isinstance(batch, (tuple, list)) else len(batch)
+
+def run_trial(cdata, epochs=2, max_batches=None):
+    """ Time `epochs` of the training loader of `cdata`, building it included """
+    cdata = deepcopy(cdata)
+    monitor = PeakRSS()
+    monitor.start()
+    start = time.perf_counter()
+    trainloader, _ = load_data(cdata["dataset"].pop("name"), **cdata)
+    setup, samples = time.perf_counter() - start, 0
+    for _ in range(epochs):
+        for b, batch in enumerate(trainloader):
+            if max_batches is not None and b >= max_batches:
+                break
+            samples += _batch_size(batch)
+    elapsed = time.perf_counter() - start
+    del trainloader # Stop persistent workers before last measure
+    return {"samples": samples, "setup": setup, "elapsed": elapsed,
+            "samples_per_s": samples / elapsed, "peak_rss": monitor.stop()}
+
+def _isolated(cdata, epochs, max_batches):
+    # Fresh process each time, so no trial inherits caches or pages of another
+    with ProcessPoolExecutor(1, mp_context=mp.get_context("spawn")) as pool:
+        return pool.submit(run_trial, cdata, epochs, max_batches).result()
+
+def _variant(cdata, workers, prefetch, persistent, cache):
+    cdata = deepcopy(cdata)
+    for k in ("num_workers", "prefetch_factor", "persistent_workers"):
+        cdata.pop(k, None)
+    cdata["num_workers"] = workers
+    if workers > 0: # DataLoader refuses them without workers
+        cdata.update(prefetch_factor=prefetch, persistent_workers=persistent)
+    cdata["dataset"]["cache"] = cache
+    return cdata
+
+def _fragment(workers, prefetch, persistent, cache):
+    # What to merge in configuration with `rec_update`
+    data = {"num_workers": workers}
+    if workers > 0:
+        data.update(prefetch_factor=prefetch, persistent_workers=persistent)
+    data["dataset"] = {"cache": cache}
+    return {"data": data}
+
+def autotune(cdata, workers, prefetches, caches, epochs=2, max_batches=None, max_rss=None):
+    """
+    Staged search over number of workers, then prefetch factor, persistent
+    workers and cache, each stage keeping the fastest setting of the previous
+    ones. Trials using more than `max_rss` bytes are discarded.
+    """
+    best = {"workers": cdata.get("num_workers", 0), "prefetch": cdata.get("prefetch_factor", 2),
+            "persistent": cdata.get("persistent_workers", False),
+            "cache": cdata["dataset"].get("cache", False)}
+    trials = {}
+    def run(setting):
+        key = repr(setting) # Caches can be dicts
+        if key not in trials:
+            spec = dict(setting)
+            if spec["workers"] == 0: # Meaningless without workers
+                spec.update(prefetch=2, persistent=False)
+            trials[key] = _isolated(_variant(cdata, *spec.values()), epochs, max_batches)
+            result = trials[key]
+            print(f"{spec}: {result['samples_per_s']:.2f} samples/s, "
+                  f"peak RSS {result['peak_rss'] / 1024 ** 3:.2f}G, setup {result['setup']:.1f}s")
+        return trials[key]
+    stages = [ ("workers", workers), ("prefetch", prefetches),
+               ("persistent", [False, True]), ("cache", caches) ]
+    for name, values in stages:
+        if name in ("prefetch", "persistent") and best["workers"] == 0:
+            continue
+        scores = []
+        for value in values:
+            result = run({**best, name: value})
+            if max_rss is None or result["peak_rss"] <= max_rss:
+                scores.append((result["samples_per_s"], value))
+        if scores:
+            best[name] = max(scores, key=lambda s: s[0])[1]
+    return best, trials
+
+
+
+@cli.command(context_settings={"help_option_names": ["-h", "--help"],
+                               "show_default": True})
+@cli.option("-c", "--config-file", type=cli.Path(exists=True), default=None,
+            help="YML of the training to tune, over `default-train.yml`.")
+@cli.option("--workers", "-w", default=None, show_default=False,
+            help="Comma separated numbers of workers to try. [default: 0, 1, 2, 4... up to number of CPUs]")
+@cli.option("--prefetch", "-p", default="2,4,8", help="Comma separated prefetch factors to try.")
+@cli.option("--caches", default="none,memory,shared",
+            help="Comma separated caches to try, 'none' for no cache.")
+@cli.option("--epochs", "-e", type=cli.IntRange(min=1), default=2,
+            help="Epochs per trial, more than one to see caches and persistent workers at work.")
+@cli.option("--max-batches", "-b", type=cli.IntRange(min=1), default=None,
+            help="Stop epochs after that many batches. [default: whole epochs]")
+@cli.option("--max-rss", default=None, help="Discard settings using more memory, e.g. 32G.")
+@cli.option("--output", "-o", "ofname", type=cli.Path(dir_okay=False, path_type=Path),
+            default="autotune.yml", help="Where to write the best settings.")
+def main(config_file, workers, prefetch, caches, epochs, max_batches, max_rss, ofname):
+    """
+    Run short trainings' data loading (no network) with several DataLoader
+    settings, each in a new process, and write the fastest as a YAML fragment
+    to merge in the training configuration.\n
+    Peak RSS counts pages shared between processes once per process.
+    """
+    with open("../config/default-train.yml", 'r') as fd:
+        config = yaml.load(fd, InclusiveLoader)
+    if config_file:
+        with open(config_file, 'r') as fd:
+            config = rec_update(config, yaml.load(fd, InclusiveLoader))
+    cdata = config["data"]
+    if workers is None:
+        workers = [ 0 ] + [ 2 ** k for k in range(os.cpu_count().bit_length()) ]
+    else:
+        workers = [ int(w) for w in workers.split(',') ]
+    prefetches = [ int(p) for p in prefetch.split(',') ]
+    caches = [ False if c == "none" else c for c in caches.split(',') ]
+    best, _ = autotune(cdata, workers, prefetches, caches, epochs, max_batches, to_bytes(max_rss))
+    fragment = _fragment(*best.values())
+    with open(ofname, 'w') as fd:
+        yaml.dump(fragment, fd, default_flow_style=False)
+    print(f"Best settings {best}, available at {ofname}")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,504 @@
+"""
+Cache backends for `_HDFDataset`, they all behave like a dict of tuple of tensors
+"""
+
+import ctypes
+import hashlib
+import json
+import multiprocessing as mp
+import numpy as np
+import os
+import re
+import socket
+import threading
+import torch
+import warnings
+
+from collections import OrderedDict
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.util import Finalize
+from pathlib import Path
+from shutil import rmtree
+from tempfile import gettempdir, mkdtemp
+from uuid import uuid4
+
+from data.hdf import LEAFLETS
+
+
+
+_DTYPES = [torch.float32, torch.float64, torch.float16, torch.bool, torch.uint8,
+           torch.int8, torch.int16, torch.int32, torch.int64]
+_MAX_NDIM = 5
+_ALIGN = 64 # Bytes
+# Where POSIX shared memory blocks are, as files
+_SHM_DIR = Path("/dev/shm")
+# Where `data.cache_server` listens by default, one daemon per user
+DAEMON_SOCKET = Path(gettempdir()).joinpath(f"mv3d-cache-{os.getuid()}.sock")
+
+
+
+def _to_numpy_dtype(dtype):
+    return torch.empty(0, dtype=dtype).numpy().dtype
+
+def pack(tensors):
+    """ Describe a tuple of tensors as a header and byte offsets in one buffer """
+    header = np.zeros(1 + len(tensors) * (2 + _MAX_NDIM), dtype=np.int64)
+    header[0] = len(tensors)
+    offsets, offset = [], _align(header.nbytes)
+    for k, t in enumerate(tensors):
+        h = 1 + k * (2 + _MAX_NDIM)
+        header[h], header[h + 1] = _DTYPES.index(t.dtype), t.ndim
+        header[h + 2:h + 2 + t.ndim] = t.shape
+        offsets.append(offset)
+        offset = _align(offset + t.numel() * t.element_size())
+    return header, offsets, offset
+
+def write_packed(buf, tensors):
+    """ Write tensors in `buf` (anything supporting the buffer protocol) """
+    header, offsets, _ = pack(tensors)
+    np.ndarray(header.shape, np.int64, buffer=buf)[:] = header
+    for t, off in zip(tensors, offsets):
+        t = torch.as_tensor(t).contiguous()
+        np.ndarray(t.shape, _to_numpy_dtype(t.dtype), buffer=buf, offset=off)[...] = t.numpy()
+
+def read_packed(buf):
+    """ Zero-copy views on tensors written by `write_packed` """
+    nb = int(np.ndarray((1,), np.int64, buffer=buf)[0])
+    header = np.ndarray((1 + nb * (2 + _MAX_NDIM),), np.int64, buffer=buf)
+    tensors, offset = [], _align(header.nbytes)
+    for k in range(nb):
+        h = 1 + k * (2 + _MAX_NDIM)
+        dtype, ndim = _DTYPES[header[h]], header[h + 1]
+        shape = tuple(header[h + 2:h + 2 + ndim])
+        arr = np.ndarray(shape, _to_numpy_dtype(dtype), buffer=buf, offset=offset)
+        tensors.append(torch.from_numpy(arr))
+        offset = _align(offset + arr.nbytes)
+    return tuple(tensors)
+
+def nbytes(tensors):
+    return pack(tensors)[-1]
+
+def _align(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+def to_bytes(size):
+    """ Accept sizes as integer or human readable string, e.g. "512M", "8GB" """
+    if size is None or isinstance(size, (int, float)):
+        return size
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)I?B?\s*", str(size).upper())
+    if match is None:
+        raise ValueError(f"Can't understand size {size}.")
+    return int(float(match[1]) * 1024 ** " KMGT".index(match[2] or ' '))
+
+
+
+class MemoryCache(dict):
+    """ Plain dict, each DataLoader worker fills its own copy """
+    shared = False # Whether other processes see what we write
+    keyed = False # Whether it needs samples' names, see `build_cache`
+    def __init__(self, size=None):
+        super(MemoryCache, self).__init__()
+
+
+class SharedMemoryCache:
+    """
+    One shared memory block per sample, seen by the main process and all
+    DataLoader workers (forked or spawned). Blocks live as long as the process
+    that built the cache, so they persist across epochs even if workers don't.
+    """
+    EMPTY, READY = 0, 1
+    shared = True
+    keyed = False
+
+    def __init__(self, size):
+        self.size = size
+        self.prefix = f"mv3d-{os.getpid()}-{uuid4().hex[:8]}"
+        # Which entries are filled, shared with workers
+        self._state = mp.RawArray(ctypes.c_uint8, size)
+        self._blocks = {} # Blocks attached by current process
+        self._pid = os.getpid()
+        Finalize(self, SharedMemoryCache._unlink_all, args=(self.prefix, self._state),
+                 exitpriority=10)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_blocks"] = {}
+        return state
+
+    def _name(self, key):
+        return f"{self.prefix}-{key}"
+
+    @staticmethod
+    def _open(name, create=False, size=0):
+        shm = SharedMemory(name, create=create, size=size)
+        # Blocks are managed by the owner of the cache, don't let the resource
+        # tracker of a worker unlink them when said worker exits
+        try:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+        return shm
+
+    @staticmethod
+    def _unlink(name):
+        try:
+            # Tracked then untracked by `unlink`, so the resource tracker stays quiet
+            shm = SharedMemory(name)
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _unlink_all(prefix, state):
+        for key in range(len(state)):
+            if state[key] != SharedMemoryCache.READY:
+                continue
+            SharedMemoryCache._unlink(f"{prefix}-{key}")
+            state[key] = SharedMemoryCache.EMPTY
+
+    @staticmethod
+    def _map(name):
+        # Python's `mmap` keeps a file descriptor per block, i.e. per sample,
+        # `ulimit -n` is soon reached. Torch closes it once mapped
+        path = _SHM_DIR.joinpath(name)
+        storage = torch.UntypedStorage.from_file(str(path), shared=True,
+                                                 nbytes=path.stat().st_size)
+        return torch.empty(0, dtype=torch.uint8).set_(storage).numpy()
+
+    def _attach(self, key):
+        if os.getpid() != self._pid: # Forked, don't use parent's attachments
+            self._blocks, self._pid = {}, os.getpid()
+        if key not in self._blocks:
+            self._blocks[key] = self._map(self._name(key))
+        return self._blocks[key]
+
+    def __contains__(self, key):
+        return self._state[key] == self.READY
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return read_packed(self._attach(key))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __setitem__(self, key, tensors):
+        if key in self:
+            return
+        try:
+            self._open(self._name(key), create=True, size=nbytes(tensors)).close()
+        except FileExistsError: # Another worker is on it
+            return
+        write_packed(self._attach(key), tensors)
+        self._state[key] = self.READY
+
+    def __len__(self):
+        return sum(s == self.READY for s in self._state)
+
+    def keys(self):
+        return [ k for k in range(self.size) if k in self ]
+
+
+class TieredCache:
+    """
+    Per-worker cache holding at most `ram_budget` bytes in RAM. Entries evicted
+    (following `policy`, "lru" or "lfu") are spilled to memory-mapped files in
+    `spill_dir`, up to `disk_budget` bytes (unlimited if None), and brought back
+    to RAM when hit again.
+    """
+    shared = False
+    keyed = False
+    def __init__(self, size=None, ram_budget="4G", policy="lru", spill_dir=None,
+                 disk_budget=None):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown eviction policy {policy}. Chose from ['lru', 'lfu'].")
+        self.ram_budget = to_bytes(ram_budget)
+        self.disk_budget = to_bytes(disk_budget)
+        self.policy = policy
+        self.spill_root = spill_dir
+        self._ram = OrderedDict() # Least recently used first
+        self._disk = OrderedDict() # Key: (path, nbytes), first spilled first
+        self._counts = {} # Number of access, for LFU
+        self.ram_bytes, self.disk_bytes = 0, 0
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+        self.evictions, self.spills, self.drops = 0, 0, 0
+        self._pid, self._spill_dir = os.getpid(), None
+
+    def __getstate__(self):
+        # Don't ship cached volumes to spawned workers, nor our spilled files
+        state = self.__dict__.copy()
+        state.update(_ram=OrderedDict(), _disk=OrderedDict(), _counts={},
+                     ram_bytes=0, disk_bytes=0, _spill_dir=None)
+        return state
+
+    def _check_fork(self):
+        if os.getpid() != self._pid:
+            # Keep inherited RAM, but spilled files belong to parent process
+            self._pid, self._spill_dir = os.getpid(), None
+            self._disk, self.disk_bytes = OrderedDict(), 0
+
+    @property
+    def spill_dir(self):
+        if self._spill_dir is None:
+            root = self.spill_root
+            if root is not None:
+                Path(root).expanduser().mkdir(parents=True, exist_ok=True)
+                root = Path(root).expanduser()
+            self._spill_dir = Path(mkdtemp(prefix=f"mv3d-cache-{os.getpid()}-", dir=root))
+            Finalize(self, rmtree, args=(str(self._spill_dir), True), exitpriority=10)
+        return self._spill_dir
+
+    def __contains__(self, key):
+        self._check_fork()
+        return key in self._ram or key in self._disk
+
+    def get(self, key, default=None):
+        # What datasets use to read, so only actual reads count as hits or misses
+        if key in self:
+            return self[key]
+        self.misses += 1
+        return default
+
+    def __getitem__(self, key):
+        self._check_fork()
+        self._counts[key] = self._counts.get(key, 0) + 1
+        if key in self._ram:
+            self.hits += 1
+            self._ram.move_to_end(key)
+            return self._ram[key]
+        if key in self._disk:
+            self.disk_hits += 1
+            path, size = self._disk[key]
+            mapped = read_packed(np.memmap(path, dtype=np.uint8, mode='c', shape=(size,)))
+            tensors = tuple(t.clone() for t in mapped)
+            self._put_ram(key, tensors)
+            return tensors
+        raise KeyError(key)
+
+    def __setitem__(self, key, tensors):
+        self._check_fork()
+        self._counts.setdefault(key, 1)
+        self._put_ram(key, tuple(tensors))
+
+    def _put_ram(self, key, tensors):
+        size = nbytes(tensors)
+        if key in self._ram:
+            return
+        while self._ram and self.ram_bytes + size > self.ram_budget:
+            self._evict()
+        if size > self.ram_budget: # Would never fit, go straight to disk
+            self._spill(key, tensors, size)
+            return
+        self._ram[key] = tensors
+        self.ram_bytes += size
+
+    def _evict(self):
+        if self.policy == "lfu": # Least used, oldest first when tied
+            key = min(self._ram, key=lambda k: self._counts.get(k, 0))
+        else:
+            key = next(iter(self._ram))
+        tensors = self._ram.pop(key)
+        size = nbytes(tensors)
+        self.ram_bytes -= size
+        self.evictions += 1
+        if key not in self._disk: # Spilled files are never modified, no need to rewrite
+            self._spill(key, tensors, size)
+
+    def _spill(self, key, tensors, size):
+        if self.disk_budget is not None:
+            while self._disk and self.disk_bytes + size > self.disk_budget:
+                _, (path, old) = self._disk.popitem(last=False)
+                path.unlink(missing_ok=True)
+                self.disk_bytes -= old
+                self.drops += 1
+            if size > self.disk_budget:
+                self.drops += 1
+                return
+        path = self.spill_dir.joinpath(f"{key}.bin")
+        mapped = np.memmap(path, dtype=np.uint8, mode="w+", shape=(size,))
+        write_packed(mapped, tensors)
+        mapped.flush()
+        del mapped
+        self._disk[key] = (path, size)
+        self.disk_bytes += size
+        self.spills += 1
+
+    def __len__(self):
+        return len(self._ram.keys() | self._disk.keys())
+
+    def keys(self):
+        return list(self._ram.keys() | self._disk.keys())
+
+    def stats(self):
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "evictions": self.evictions, "spills": self.spills, "drops": self.drops,
+                "ram_bytes": self.ram_bytes, "disk_bytes": self.disk_bytes,
+                "ram_entries": len(self._ram), "disk_entries": len(self._disk)}
+
+
+class DaemonCache:
+    """
+    Samples held by a `data.cache_server` daemon listening on `socket`, in
+    shared memory, so all datasets, processes and runs of the machine share
+    them. Entries are named after file, frame and file's size and modification
+    time, so they outlive runs but not changes of the files. If the daemon
+    goes away during a run, samples are just read again.
+    """
+    shared = True
+    keyed = True
+    def __init__(self, size, key=None, socket=None):
+        if key is None:
+            raise ValueError("Daemon cache needs samples' names, let the dataset build it.")
+        self.size, self.key = size, key
+        self.socket = str(Path(socket or DAEMON_SOCKET).expanduser())
+        self._reset()
+        try:
+            self._request({"op": "ping"})
+        except OSError as err:
+            raise ConnectionError(f"No cache daemon on {self.socket}, start it with "
+                                  "`python -m data.cache_server serve`.") from err
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._conn, self._reader = None, None
+        self._lock = threading.Lock() # Readahead threads share the connection
+        self._warned = False
+
+    def __getstate__(self):
+        # Each process opens its own connection
+        state = self.__dict__.copy()
+        for k in ("_conn", "_reader", "_lock"):
+            state.pop(k)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _request(self, message):
+        if os.getpid() != self._pid: # Forked, parent's connection isn't ours
+            self._reset()
+        with self._lock:
+            try:
+                if self._conn is None:
+                    self._conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self._conn.connect(self.socket)
+                    self._reader = self._conn.makefile('rb')
+                self._conn.sendall(json.dumps(message).encode() + b"\n")
+                reply = self._reader.readline()
+                if not reply:
+                    raise ConnectionError(f"Cache daemon on {self.socket} closed the connection.")
+                return json.loads(reply)
+            except OSError:
+                if self._conn is not None:
+                    self._conn.close()
+                self._conn, self._reader = None, None
+                raise
+
+    def _lost(self, err):
+        if not self._warned:
+            warnings.warn(f"Cache daemon unreachable, reading samples instead ({err}).")
+            self._warned = True
+
+    def _ask(self, message):
+        # Daemon's reply, None if it's gone or failed to answer
+        try:
+            reply = self._request(message)
+        except OSError as err:
+            self._lost(err)
+            return None
+        if "error" in reply:
+            self._lost(reply["error"])
+            return None
+        return reply
+
+    def _digest(self, i):
+        # Labels' packing is part of what is cached
+        name = json.dumps([LEAFLETS, self.key(i)])
+        return hashlib.sha1(name.encode()).hexdigest()[:24]
+
+    def _get(self, i):
+        reply = self._ask({"op": "get", "key": self._digest(i)})
+        if reply is None or reply["block"] is None:
+            return None
+        try:
+            shm = SharedMemoryCache._open(reply["block"])
+        except FileNotFoundError: # Evicted in between
+            return None
+        # Block can be evicted anytime, copy it before letting it go
+        mapped = read_packed(shm.buf)
+        tensors = tuple(t.clone() for t in mapped)
+        del mapped
+        shm.close()
+        return tensors
+
+    def __contains__(self, i):
+        # Only asks the daemon, reading happens in `get`
+        reply = self._ask({"op": "has", "key": self._digest(i)})
+        return reply is not None and reply["found"]
+
+    def __getitem__(self, i):
+        tensors = self._get(i)
+        if tensors is None:
+            raise KeyError(i)
+        return tensors
+
+    def get(self, i, default=None):
+        tensors = self._get(i)
+        return default if tensors is None else tensors
+
+    def __setitem__(self, i, tensors):
+        key = self._digest(i)
+        block = f"mv3d-{key}-{uuid4().hex[:8]}"
+        # Tracked until the daemon owns it, so it can't outlive us if anything goes wrong
+        shm = SharedMemory(block, create=True, size=nbytes(tensors))
+        reply = None
+        try:
+            write_packed(shm.buf, tensors)
+            reply = self._ask({"op": "put", "key": key, "block": block, "nbytes": shm.size})
+        finally:
+            shm.close()
+            if reply is not None and reply["kept"]:
+                resource_tracker.unregister(shm._name, "shared_memory")
+            else:
+                shm.unlink()
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return [ i for i in range(self.size) if i in self ]
+
+    def stats(self):
+        return self._request({"op": "stats"})
+
+
+
+CACHES = {"memory": MemoryCache, "shared": SharedMemoryCache, "tiered": TieredCache,
+          "daemon": DaemonCache}
+
+
+
+def build_cache(cache, size, key=None):
+    """
+    `cache` is either a boolean (`True` being the per-worker dict), the name of
+    a backend, or a dict with the backend's `name` and its parameters.
+    `key(i)` names sample `i` the same way in every dataset and run, for
+    backends shared between them (`keyed`).
+    """
+    if not cache:
+        return None
+    if cache is True:
+        cache = "memory"
+    kwargs = {}
+    if isinstance(cache, dict):
+        kwargs = dict(cache)
+        cache = kwargs.pop("name")
+    if cache not in CACHES:
+        raise ValueError(f"Unknown cache {cache}. Chose one from {list(CACHES.keys())}.")
+    if CACHES[cache].keyed:
+        kwargs["key"] = key
+    return CACHES[cache](size, **kwargs)
@@ -0,0 +1,169 @@
+"""
+Daemon holding samples in shared memory for `data.cache.DaemonCache`, so that
+several trainings of the same data share one cache that outlives them. Run as
+`python -m data.cache_server serve` and leave it running.
+"""
+
+import click as cli
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+
+from collections import OrderedDict
+from pathlib import Path
+
+from data.cache import DAEMON_SOCKET, SharedMemoryCache, to_bytes
+
+
+
+class CacheServer:
+    """
+    Blocks written by clients, least recently used ones unlinked to stay under
+    `budget` bytes. Processes still reading an unlinked block keep it until
+    they close it, so evictions never break a read.
+    """
+    def __init__(self, budget):
+        self.budget = to_bytes(budget)
+        self.entries = OrderedDict() # Key: (block, nbytes), least recently used first
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions, self.refused = 0, 0, 0, 0
+        self._lock = threading.Lock()
+
+    def handle(self, message):
+        op = message.get("op")
+        with self._lock:
+            if op == "ping":
+                return {"ok": True}
+            if op == "has": # Cheap check, no block and no stats
+                return {"found": message["key"] in self.entries}
+            if op == "get":
+                return self._get(message["key"])
+            if op == "put":
+                return self._put(message["key"], message["block"], message["nbytes"])
+            if op == "stats":
+                return self.stats()
+            if op == "clear":
+                self.clear()
+                return {"ok": True}
+        return {"error": f"Unknown operation {op}."}
+
+    def _get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return {"block": None}
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return {"block": self.entries[key][0]}
+
+    def _put(self, key, block, nbytes):
+        if key in self.entries or nbytes > self.budget: # Already there or would never fit
+            self.refused += 1
+            return {"kept": False}
+        while self.entries and self.nbytes + nbytes > self.budget:
+            _, (old, size) = self.entries.popitem(last=False)
+            SharedMemoryCache._unlink(old)
+            self.nbytes -= size
+            self.evictions += 1
+        self.entries[key] = (block, nbytes)
+        self.nbytes += nbytes
+        return {"kept": True}
+
+    def clear(self):
+        for block, _ in self.entries.values():
+            SharedMemoryCache._unlink(block)
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "nbytes": self.nbytes, "budget": self.budget,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "refused": self.refused}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # One connection per client process, one JSON message per line
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = self.server.cache.handle(json.loads(line))
+            except (ValueError, KeyError) as err:
+                reply = {"error": str(err)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def request(path, message):
+    """ One-off message to the daemon listening on `path` """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(str(path))
+        conn.sendall(json.dumps(message).encode() + b"\n")
+        return json.loads(conn.makefile('rb').readline())
+
+def serve(path, budget):
+    path = Path(path).expanduser()
+    if path.exists():
+        try:
+            request(path, {"op": "ping"})
+            raise FileExistsError(f"A cache daemon already listens on {path}.")
+        except ConnectionRefusedError: # Left by a daemon that was killed
+            path.unlink()
+    cache = CacheServer(budget)
+    server = _Server(str(path), _Handler)
+    server.cache = cache
+    os.chmod(path, 0o600) # Blocks are readable by the user only anyway
+    # Clean up on `kill` too, not only on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"Cache daemon listening on {path}, budget of {cache.budget} bytes")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        cache.clear()
+        path.unlink(missing_ok=True)
+        print("Cache daemon stopped, all blocks freed")
+
+
+
+_socket = cli.option("--socket", "-s", "path", default=DAEMON_SOCKET,
+                     type=cli.Path(dir_okay=False, path_type=Path),
+                     help="Unix socket the daemon listens on.")
+
+@cli.group(context_settings={"help_option_names": ["-h", "--help"],
+                             "show_default": True})
+def main():
+    """ Cache of samples shared by all trainings of the machine """
+
+
+@main.command("serve")
+@_socket
+@cli.option("--budget", "-b", default="8G", help="Memory held at most, e.g. 512M, 16G.")
+def run(path, budget):
+    """ Run the daemon until interrupted """
+    serve(path, budget)
+
+
+@main.command()
+@_socket
+def stats(path):
+    """ Print what the daemon holds """
+    print(json.dumps(request(path, {"op": "stats"}), indent=2))
+
+
+@main.command()
+@_socket
+def clear(path):
+    """ Drop everything the daemon holds """
+    request(path, {"op": "clear"})
+
+
+
+if __name__ == "__main__":
+    main()
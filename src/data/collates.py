@@ -4,6 +4,9 @@ Custom `collate_fn` for PyTorch Dataloader
 
 import torch
 
+from torch.utils.data import default_collate
+
+from data.transforms import expand_batch
 from utils import TensorList
 
 
@@ -14,3 +17,57 @@ def collate_tensorlist(batch):
     tmp = [ b[1] for b in batch ]
     targets = TensorList(*[ torch.stack(elt) for elt in zip(*tmp) ])
     return inputs, targets
+
+
+def collate_crops(batch, collate_fn=None):
+    # Receive [[crop, ...], ...] from datasets with several `crops_per_volume`
+    # Crops become samples of the batch, so it's `crops_per_volume` times larger
+    return (collate_fn or default_collate)([ crop for crops in batch for crop in crops ])
+
+
+class CompactBatch:
+    """
+    Raw inputs and label maps as given by datasets with `transport="compact"`.
+    Lightning moves it to the training device with `to`, and
+    `EnhancedLightningModule.on_after_batch_transfer` expands it there, then
+    applies `augment` if any (see `collate_augmented`).
+    """
+    def __init__(self, inputs, labels, stats, spec, augment=None):
+        self.inputs, self.labels, self.stats, self.spec = inputs, labels, stats, spec
+        self.augment = augment
+
+    def to(self, *args, **kwargs):
+        return CompactBatch(self.inputs.to(*args, **kwargs), self.labels.to(*args, **kwargs),
+                            self.stats.to(*args, **kwargs), self.spec, self.augment)
+
+    def expand(self):
+        vin, vout = expand_batch(self.inputs, self.labels, self.stats, **self.spec, inside_bit=True)
+        if self.augment is not None:
+            return self.augment(vin, vout)
+        return vin, vout
+
+    def __len__(self):
+        return len(self.inputs)
+
+
+def collate_compact(batch, spec):
+    # Receive [(raw input, label map, intensity stats), ...], spec is dataset's `expansion`
+    inputs, labels, stats = [ torch.stack(elt) for elt in zip(*batch) ]
+    return CompactBatch(inputs, labels, stats, spec)
+
+
+def collate_augmented(batch, augment, collate_fn=None):
+    # Augment the whole batch at once, see `data.augmentations.BatchAugmentation`
+    # Compact batches are augmented once expanded, on the training device
+    out = (collate_fn or default_collate)(batch)
+    if isinstance(out, CompactBatch):
+        out.augment = augment
+        return out
+    return (*augment(out[0], out[1]), *out[2:])
+
+
+def collate_stream(batch):
+    # Receive [(input, target, metadata), ...] or [(input, metadata), ...]
+    # Metadata stays a list of dict, one per item, for writers to use as is
+    *volumes, meta = zip(*batch)
+    return (*[ torch.stack(v) for v in volumes ], list(meta))
@@ -0,0 +1,95 @@
+"""
+Convert a directory of echovox HDFs to flat memory-mapped arrays, so frames can
+be read without decompressing anything. Run as `python -m data.convert`.
+"""
+
+import click as cli
+import h5py
+import json
+import numpy as np
+import yaml
+
+from pathlib import Path
+
+from data.hdf import LEAFLETS
+
+
+
+INDEX = "index.json"
+INPUTS, LABELS = "inputs.raw", "labels.raw"
+
+
+
+def load_store_index(pstore):
+    with open(Path(pstore).joinpath(INDEX), 'r') as fd:
+        return json.load(fd)
+
+
+def _list_files(pdata, split):
+    if split is None:
+        return sorted(f for f in pdata.iterdir() if f.suffix == ".h5")
+    with open(split, 'r') as fd:
+        split = yaml.safe_load(fd)
+    fnames = [ f[0] for subset in ("train", "validation", "test")
+                    for f in split.get(subset, {}).get("files", []) ]
+    return [ pdata.joinpath(f) for f in fnames ]
+
+
+@cli.command(context_settings={"help_option_names": ["-h", "--help"],
+                               "show_default": True})
+@cli.argument("pdata", type=cli.Path(exists=True, resolve_path=True, file_okay=False,
+              path_type=Path))
+@cli.argument("pstore", type=cli.Path(resolve_path=True, file_okay=False, path_type=Path))
+@cli.option("--split", "-s", type=cli.Path(exists=True, dir_okay=False, path_type=Path),
+            default=None, help="Only convert files listed in this data split.")
+def convert(pdata, pstore, split):
+    """
+    Write all frames of all HDFs in PDATA as two flat arrays (inputs and packed
+    leaflets' labels) plus an index of offsets, shapes and number of frames.\n
+    Use it with the `Memmap*Dataset` by giving PSTORE as `prefix`.
+
+    PDATA     DIR    Path to directory containing data in HDF format.\n
+    PSTORE    DIR    Where to write the converted data.
+    """
+    pstore.mkdir(parents=True, exist_ok=True)
+    index = {"labels": LEAFLETS, "input_dtype": None, "files": {}}
+    offset = 0 # In voxels, same for inputs and labels
+    with open(pstore.joinpath(INPUTS), "wb") as fin, open(pstore.joinpath(LABELS), "wb") as flab:
+        for fname in _list_files(pdata, split):
+            # Named as in data splits, files of different subdirectories can share their name
+            key = fname.relative_to(pdata).as_posix()
+            if key in index["files"]: # Listed in several subsets
+                continue
+            hdf = h5py.File(fname, 'r')
+            nbf = int(hdf["VolumeGeometry"]["frameNumber"][()])
+            entry = {"nbf": nbf, "offset": offset}
+            for k in ("origin", "directions", "resolution"):
+                entry[k] = hdf["VolumeGeometry"][k][()].tolist()
+            for iframe in range(1, nbf + 1):
+                vin = hdf["CartesianVolume"][f"vol{iframe:02d}"][()]
+                label = np.zeros(vin.shape, dtype=np.uint8)
+                for leaflet, bit in LEAFLETS.items():
+                    label |= (hdf["GroundTruth"][f"{leaflet}-{iframe:02d}"][()] != 0).astype(np.uint8) * np.uint8(bit)
+                if index["input_dtype"] is None:
+                    index["input_dtype"] = vin.dtype.str
+                elif index["input_dtype"] != vin.dtype.str:
+                    raise ValueError(f"{key} inputs are {vin.dtype}, expected {np.dtype(index['input_dtype'])}.")
+                # All frames of a sequence share the same grid
+                entry.setdefault("shape", list(vin.shape))
+                if list(vin.shape) != entry["shape"]:
+                    raise ValueError(f"{key} frame {iframe} has shape {vin.shape}, expected {entry['shape']}.")
+                fin.write(np.ascontiguousarray(vin).tobytes())
+                flab.write(label.tobytes())
+                offset += vin.size
+            hdf.close()
+            index["files"][key] = entry
+            print(f"Converted {key} ({nbf} frames)")
+    index["total_voxels"] = offset
+    with open(pstore.joinpath(INDEX), 'w') as fd:
+        json.dump(index, fd)
+    print(f"Store available at {pstore}")
+
+
+
+if __name__ == "__main__":
+    convert()
@@ -1,4 +1,9 @@
 from data.datasets.frames import FrameDataset, MiddleFrameDataset, ListMiddleFrameDataset
 from data.datasets.sequences import SequenceDataset, ListSequenceDataset
+from data.datasets.memmap import MemmapFrameDataset, MemmapMiddleFrameDataset, \
+                                 ListMemmapMiddleFrameDataset, MemmapSequenceDataset, \
+                                 ListMemmapSequenceDataset
+from data.datasets.streaming import HDFStreamDataset
+from data.datasets.shards import ShardDataset
 
 from data.datasets.misc import DummyDataset
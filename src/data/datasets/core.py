@@ -1,14 +1,23 @@
-import h5py
-
 import monai.transforms as mt
+import numpy as np
+import os
 import torch
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from itertools import accumulate # Faster than numpy if you manipulate list
 from pathlib import Path
 from torch import from_numpy as fnp
 from torch.utils.data import Dataset
+from tqdm import tqdm
 
-from data.transforms import NORMS, RESIZE
+from data.augmentations import BatchAugmentation
+from data.cache import build_cache
+from data.hdf import LEAFLETS, HDFHandlePool, ReadBuffers, read_labels, read_volume
+from data.indices import ForegroundIndices
+from data.metadata import METADATA, file_signature, is_stale, load_metadata
+from data.prefetch import ReadAhead
+from data.transforms import INSIDE, NORMS, RESIZE, augmentations, decode_labels, \
+                            expand_batch, intensity_stats
 from utils import TensorList
 
 
@@ -17,19 +26,56 @@ class _HDFDataset(Dataset):
     """ Load volume from HDF using specific architecture """
     def __init__(self, data_dir, hdfnames, multiclass=False, 
                  resize="center-random", spatial_size=[128, 128, 128],
-                 norm="256", contrast=None, augmentation=False, cache=False):
+                 norm="256", contrast=None, augmentation=False, cache=False,
+                 max_open_files=16, transport="dense", read_threads=0,
+                 readahead=0, readahead_threads=2, preload=False, preload_workers=None,
+                 metadata=False, partial_reads=False, read_margin=16, class_indices=False,
+                 crops_per_volume=1):
         super(_HDFDataset, self).__init__()
         self.prefixes = self._setup_prefixes(data_dir)
         self._setup_indexes(hdfnames)
+        self.paths = self._setup_paths()
+        # Stat files once, cached samples are named after them
+        self.signatures = [ self._source_signature(iseq) for iseq in range(len(self.fnames)) ]
+        # Index written by `data.preprocess`, True to look for it next to HDFs
+        self.metadata = self._setup_metadata(metadata)
         self.multiclass = multiclass
         keys = ["in", "out"]
         self.resize = RESIZE[resize](keys, spatial_size, multiclass=multiclass)
+        self.resize_mode = resize
         self.norm = NORMS[norm]
         self.contrast = mt.AdjustContrast(contrast) if contrast is not None\
                             else contrast
-        self.augmentation = self._define_augmentations(keys) if augmentation\
-                                else augmentation
-        self.cache = {} if cache else None
+        # With "batch", batches are augmented once collated instead, see `data.augmentations`
+        self.batch_augmentation = BatchAugmentation() if augmentation == "batch" else None
+        self.augmentation = self._define_augmentations(keys)\
+                                if augmentation and self.batch_augmentation is None else False
+        # See `data.cache.build_cache` for available caches
+        self.cache = build_cache(cache, len(self), self._cache_key)
+        # Opened HDFs are kept per worker, set `max_open_files` to 0 to disable
+        self.handles = HDFHandlePool(max_open_files)
+        # Scratch arrays leaflets' masks are read into, per thread
+        self.buffers = ReadBuffers()
+        # Leaflets' voxels for crops by classes, True to keep them in memory or a sidecar directory
+        self.class_indices = None if not class_indices else \
+                                ForegroundIndices(None if class_indices is True else class_indices)
+        # With "compact", samples are shipped raw and expanded on the training device
+        self._setup_transport(transport, resize, augmentation)
+        self.expansion = {"norm": norm, "contrast": contrast, "multiclass": multiclass,
+                          "as_list": False}
+        # Threads used to read all frames of a sequence in `get_sequence`
+        self.read_threads = read_threads
+        # Number of samples read in advance by each worker, see `data.prefetch`
+        self.readahead = ReadAhead(readahead, readahead_threads) if readahead > 0 else None
+        # Only read crop windows, see `_load_window`
+        self._setup_partial_reads(partial_reads, read_margin, keys, spatial_size)
+        # Crops taken from each loaded (and augmented) volume, batch them with `collate_crops`
+        if partial_reads and crops_per_volume > 1:
+            raise ValueError("Partial reads only read one crop, they can't give several crops per volume.")
+        self.crops_per_volume = crops_per_volume
+        # Fill the cache now rather than during first epoch
+        if preload:
+            self.preload("threads" if preload is True else preload, preload_workers)
 
     def _setup_prefixes(self, prefixes):
         if isinstance(prefixes, list):
@@ -47,87 +93,327 @@ class _HDFDataset(Dataset):
             nbf_per_seq.append(d[1])
         self.cumulative_nbf = list(accumulate(nbf_per_seq, initial=0))
 
+    def _setup_paths(self):
+        # Resolve files once, so we don't stat every prefix at each read
+        paths, missing = [], []
+        for fname in self.fnames:
+            for p in self.prefixes:
+                if p.joinpath(fname).is_file():
+                    paths.append(p.joinpath(fname))
+                    break
+            else:
+                missing.append(fname)
+        if missing:
+            raise FileNotFoundError(f"{len(missing)} file(s) not found in {list(map(str, self.prefixes))}: {missing}")
+        return paths
+
+    def _setup_metadata(self, metadata):
+        # One entry per sequence, None if unknown or outdated
+        if not metadata:
+            return [ None ] * len(self.fnames)
+        fnames = [ p.joinpath(METADATA) for p in self.prefixes ] if metadata is True\
+                    else [ Path(metadata).expanduser() ]
+        entries = {}
+        for fname in fnames:
+            if fname.is_file():
+                entries.update(load_metadata(fname))
+        out = [ entries.get(fname) for fname in self.fnames ]
+        # Only compare size and modification time, i.e. no need to open files
+        stale = [ f for f, e, p in zip(self.fnames, out, self.paths) if e is not None and is_stale(e, p) ]
+        out = [ None if f in stale else e for f, e in zip(self.fnames, out) ]
+        unknown = sum(e is None for e in out)
+        if unknown:
+            print(f"No up-to-date metadata for {unknown} file(s) ({len(stale)} outdated), "
+                  "rerun `python -m data.preprocess` to refresh it.")
+        return out
+
+    def _setup_transport(self, transport, resize, augmentation):
+        if transport not in ("dense", "compact"):
+            raise ValueError(f"Unknown transport {transport}. Chose from ['dense', 'compact'].")
+        if transport == "compact" and augmentation and augmentation != "batch":
+            raise ValueError("Augmentations need dense volumes, use `augmentation: batch` with compact transport.")
+        if transport == "compact" and resize == "by-classes" and self.class_indices is None:
+            raise ValueError("Cropping by classes needs one-hot targets or `class_indices` to be used with compact transport.")
+        self.transport = transport
+
+    def _setup_partial_reads(self, partial_reads, read_margin, keys, spatial_size):
+        if partial_reads and self.cache is not None:
+            raise ValueError("Partial reads give a different crop each time, they can't be cached.")
+        if partial_reads and (self.expansion["norm"] != "256" or self.contrast is not None):
+            raise ValueError("Partial reads need normalisation independent from the whole volume, "
+                             "i.e. `norm: \"256\"` and no contrast.")
+        self.partial_reads = partial_reads
+        # Extra voxels around the window, so augmentations don't move padding in
+        self.read_margin = read_margin if self.augmentation else 0
+        # Read volumes are already cropped, only remove the margin and pad
+        self.trim = RESIZE["center"](keys, spatial_size)
+
     def _define_augmentations(self, keys):
-        return mt.Compose([
-            # Move around (input, target)
-            mt.RandRotated(keys, range_x=5, range_y=5, range_z=5),
-            mt.RandAxisFlipd(keys),
-            # Add noise to input
-            mt.RandGaussianNoised(keys[0]),
-            mt.RandGridDistortiond(keys[0]),
-            mt.Rand3DElasticd(keys[0], (5, 7), (50, 150))
-            # And many more...
-        ])
-
-
-    def do_transform(self, inp, out, transform):
-        data = mt.apply_transform(transform, {"in": inp, "out": out})
+        return augmentations(keys)
+
+
+    def preload(self, mode="threads", workers=None):
+        """
+        Read all samples not cached yet with a pool of `workers` threads or
+        processes (`mode`). Processes write straight to a shared cache, so pair
+        them with `cache: shared` or results are sent back to this process.
+        """
+        if self.cache is None:
+            raise ValueError("Nothing to preload without a cache, set `cache` too.")
+        if mode not in ("threads", "processes"):
+            raise ValueError(f"Unknown preload mode {mode}. Chose from ['threads', 'processes'].")
+        missing = [ i for i in range(len(self)) if i not in self.cache ]
+        workers = workers or os.cpu_count()
+        if mode == "threads":
+            pool = ThreadPoolExecutor(workers)
+            load = lambda i: (i, self._load_volumes(*self._locate(i)))
+            results = pool.map(load, missing)
+        else:
+            pool = ProcessPoolExecutor(workers, initializer=_set_preloaded, initargs=(self,))
+            results = pool.map(_preload_one, missing, chunksize=max(len(missing) // (4 * workers), 1))
+        with pool:
+            for i, volumes in tqdm(results, total=len(missing), unit="sample",
+                                   desc=f"Preloading {type(self).__name__}"):
+                if volumes is not None: # Otherwise already in shared cache
+                    self.cache[i] = volumes
+
+    def do_transform(self, inp, out, transform, **extra):
+        data = mt.apply_transform(transform, {"in": inp, "out": out, **extra})
         return data["in"], data["out"]
 
 
-    def _load_volumes(self, iseq, iframe):
+    def _read_hdf(self, hdfile, iframe, vin=None, label=None):
+        # Compact frame read into `vin` and `label` arrays if given
         #FIXME: Handle negative index
-        #FIXME: Bottleneck if no cache
-        hdfile = h5py.File(self.get_path(iseq), 'r')
         iframe += 1 # Indexes start at 1 in HDF
-        vin = fnp(hdfile["CartesianVolume"][f"vol{iframe:02d}"][()])
-        ant = hdfile["GroundTruth"][f"anterior-{iframe:02d}"][()]
-        post = hdfile["GroundTruth"][f"posterior-{iframe:02d}"][()]
-        ant, post = fnp(ant).to(torch.bool), fnp(post).to(torch.bool)
-        hdfile.close()
+        vin = read_volume(hdfile["CartesianVolume"][f"vol{iframe:02d}"], out=vin)
+        label = read_labels(hdfile["GroundTruth"][f"anterior-{iframe:02d}"],
+                            hdfile["GroundTruth"][f"posterior-{iframe:02d}"], self.buffers, out=label)
+        return fnp(vin), fnp(label)
+
+    def _read_frame(self, iseq, iframe):
+        with self.handles.open(self.get_path(iseq)) as hdfile:
+            return self._read_hdf(hdfile, iframe)
+
+    def _load_volumes(self, iseq, iframe):
+        # Keep it compact: raw intensities and one label map for both leaflets
+        return self._read_frame(iseq, iframe)
+
+    def _load_sequence(self, iseq):
+        # All frames of a sequence in one go, read straight into (F, W, H, D) arrays
+        nbf = self.cumulative_nbf[iseq + 1] - self.cumulative_nbf[iseq]
+        with self.handles.open(self.get_path(iseq)) as hdfile:
+            first = hdfile["CartesianVolume"]["vol01"]
+            vins = np.empty((nbf, *first.shape), first.dtype)
+            labels = np.empty((nbf, *first.shape), np.uint8)
+            read = lambda iframe: self._read_hdf(hdfile, iframe, vins[iframe], labels[iframe])
+            if self.read_threads > 0:
+                with ThreadPoolExecutor(self.read_threads) as pool:
+                    list(pool.map(read, range(nbf)))
+            else:
+                list(map(read, range(nbf)))
+        return fnp(vins), fnp(labels)
+
+    def _foreground(self, iseq, iframe, get_label):
+        # Indices of leaflets' voxels in whole frame, see `data.indices`
+        if self.class_indices is None:
+            return None
+        return self.class_indices.get(self.get_path(iseq), iframe, get_label,
+                                      self.signatures[iseq])
+
+    def _leaflet_bboxes(self, iseq, iframe):
+        # Per class but background, from metadata, None if unknown
+        if self.metadata[iseq] is None:
+            return None
+        leaflets = self.metadata[iseq]["frames"][iframe]["leaflets"]
+        bboxes = [ leaflets[l]["bbox"] for l in LEAFLETS ]
         if self.multiclass:
-            #FIXME: Some voxel are in both ant & post class
-            none = ~(ant | post)
-            vout = torch.stack([none, ant, post])
-        else:
-            leaflet = (ant | post)
-            # This way is easier to handle both multiclass and binary class
-            vout = torch.stack([~leaflet, leaflet])
-        return self.norm(vin), vout
+            return bboxes
+        # Both leaflets are the same class
+        found = [ b for b in bboxes if b is not None ]
+        if not found:
+            return [ None ]
+        return [ [ [ min(b[0][k] for b in found) for k in range(3) ],
+                   [ max(b[1][k] for b in found) for k in range(3) ] ] ]
+
+    def _window(self, iseq, iframe, shape, get_label):
+        # Crop window drawn before reading anything, `get_label` is only called if needed
+        label, bboxes, indices = None, None, None
+        if self.resize_mode == "by-classes":
+            indices = self._foreground(iseq, iframe, get_label)
+            bboxes = self._leaflet_bboxes(iseq, iframe) if indices is None else None
+            if indices is None and bboxes is None:
+                label = decode_labels(get_label(), self.multiclass)
+        slices = self.resize.window(shape, label=label, bboxes=bboxes, indices=indices)
+        # Same margin on both sides, so the window stays centered in what's read
+        margins = [ min(self.read_margin, s.start, n - s.stop) for s, n in zip(slices, shape) ]
+        return tuple(slice(s.start - m, s.stop + m) for s, m in zip(slices, margins))
+
+    def _load_window(self, iseq, iframe):
+        # Only read the hyperslab of the crop, chunks outside of it aren't decompressed
+        with self.handles.open(self.get_path(iseq)) as hdfile:
+            dset = hdfile["CartesianVolume"][f"vol{iframe + 1:02d}"]
+            ant = hdfile["GroundTruth"][f"anterior-{iframe + 1:02d}"]
+            post = hdfile["GroundTruth"][f"posterior-{iframe + 1:02d}"]
+            read = {}
+            def get_label(): # Whole label map, for crops by classes without metadata
+                read["label"] = fnp(read_labels(ant, post, self.buffers))
+                return read["label"]
+            slices = self._window(iseq, iframe, dset.shape, get_label)
+            vin = fnp(read_volume(dset, slices))
+            if "label" in read:
+                return vin, read["label"][slices].contiguous()
+            return vin, fnp(read_labels(ant, post, self.buffers, slices))
+
+    def _fetch_volumes(self, i, iseq, iframe):
+        load = self._load_window if self.partial_reads else self._load_volumes
+        if self.readahead is None:
+            return load(iseq, iframe)
+        skip = None if self.cache is None else (lambda j: j in self.cache)
+        return self.readahead.fetch(i, lambda j: load(*self._locate(j)), skip=skip)
+
+    def _locate(self, i):
+        # (iseq, iframe) of general index i
+        raise NotImplementedError
+
+    def _source_signature(self, iseq):
+        # Changes whenever what `_load_volumes` reads for sequence iseq changes
+        return file_signature(self.get_path(iseq))
+
+    def _cache_key(self, i):
+        # Same for a frame in any dataset and run, for caches shared between them
+        iseq, iframe = self._locate(i)
+        return [ str(self.get_path(iseq)), iframe, self.signatures[iseq] ]
+
+    def expand_volumes(self, vin, label):
+        # Gray scale, i.e. 1 channel, need float to compute loss
+        vin = self.norm(vin.unsqueeze(0))
+        if self.contrast is not None:
+            vin = self.contrast(vin)
+        return vin, decode_labels(label, self.multiclass).to(torch.float)
 
-    def get_path(self, i): # Not the prettiest
-        for p in self.prefixes:
-            if p.joinpath(self.fnames[i]).is_file():
-                return p.joinpath(self.fnames[i])
+    def get_path(self, i):
+        return self.paths[i]
 
-    def get_volumes(self, i, iseq, iframe):
+    def get_voxinfo(self, iseq):
+        # Additionnal informations on voxel grid, same for all frames of a sequence
+        if self.metadata[iseq] is not None:
+            return tuple(np.array(self.metadata[iseq][k]) for k in ("origin", "directions", "resolution"))
+        with self.handles.open(self.get_path(iseq)) as hdf:
+            origin = hdf["VolumeGeometry"]["origin"][()]
+            directions = hdf["VolumeGeometry"]["directions"][()]
+            spacing = hdf["VolumeGeometry"]["resolution"][()]
+        # Same order as required for VoxelGrid
+        return origin, directions, spacing
+
+    def get_volumes(self, i, iseq, iframe, transport=None, crops=None):
         # i is the general index of the dataset
+        # With more than one crop (default to `crops_per_volume`), a list of samples is returned
         # If you run on a big enough machine, take advantage of it :3
-        if self.cache is not None and i in self.cache.keys():
-            vin, vout = self.cache[i]
+        cached = None if self.cache is None else self.cache.get(i)
+        if cached is not None:
+            vin, label = cached
         else:
-            vin, vout = self._load_volumes(iseq, iframe)
-            # Gray scale, i.e. 1 channel, need float to compute loss
-            vin, vout = vin.unsqueeze(0), vout.to(torch.float)
-            if self.contrast is not None:
-                vin = self.contrast(vin)
+            vin, label = self._fetch_volumes(i, iseq, iframe)
             if self.cache is not None:
-                self.cache[i] = (vin, vout)
+                self.cache[i] = (vin, label)
+        # Partial reads already cropped the window
+        resize = self.trim if self.partial_reads else self.resize
+        extra = {}
+        if resize is self.resize and self.resize_mode == "by-classes" and not self.augmentation:
+            # Augmentations move voxels, indices only hold for volumes as read
+            foreground = self._foreground(iseq, iframe, lambda: label)
+            extra = {} if foreground is None else {"indices": foreground}
+        crops = crops or self.crops_per_volume
+        if (transport or self.transport) == "compact":
+            # See `data.collates.CompactBatch`, only crop is done here
+            stats = intensity_stats(vin, **{k: self.expansion[k] for k in ("norm", "contrast")})
+            # Tell actual voxels from padding once expanded
+            vin, label = vin.unsqueeze(0), (label | INSIDE).unsqueeze(0)
+            samples = [ (*self.do_transform(vin, label, resize, **extra), stats)
+                            for _ in range(crops) ]
+            return samples[0] if crops == 1 else samples
+        # Cache stays compact, normalisation and one-hot are cheap enough
+        vin, vout = self.expand_volumes(vin, label)
         if self.augmentation: # Random so don't cache it
             vin, vout = self.do_transform(vin, vout, self.augmentation)
         # Can be random, so don't cache it
-        return self.do_transform(vin, vout, self.resize)
+        samples = [ self.do_transform(vin, vout, resize, **extra) for _ in range(crops) ]
+        return samples[0] if crops == 1 else samples
+
+    def format_target(self, vout):
+        # One-hot (C, W, H, D) is what the network expects
+        return vout
+
+    def get_sequence(self, iseq):
+        # Get all frames from a specific sequence at once, always dense for callbacks
+        first, nbf = self.cumulative_nbf[iseq], self.cumulative_nbf[iseq + 1] - self.cumulative_nbf[iseq]
+        if self.augmentation or self.resize_mode != "center":
+            # Random transforms are drawn per frame anyway
+            frames = [ self.get_volumes(first + f, iseq, f, transport="dense", crops=1)
+                        for f in range(nbf) ]
+            return [ f[0] for f in frames ], [ f[1] for f in frames ]
+        cached = [ None ]
+        if self.cache is not None and all(first + f in self.cache for f in range(nbf)):
+            # Shared caches can still evict frames in between
+            cached = [ self.cache.get(first + f) for f in range(nbf) ]
+        if all(c is not None for c in cached):
+            vins, labels = torch.stack([ c[0] for c in cached ]), torch.stack([ c[1] for c in cached ])
+        else:
+            vins, labels = self._load_sequence(iseq)
+        stats = torch.stack([ intensity_stats(v, self.expansion["norm"], self.expansion["contrast"])
+                                for v in vins ])
+        spec = dict(self.expansion, as_list=False)
+        vin, vout = expand_batch(vins.unsqueeze(1), labels.unsqueeze(1), stats, **spec)
+        # Deterministic resize done once for the whole sequence, frames stacked as channels
+        nbc = vout.shape[1]
+        vin, vout = self.do_transform(vin.flatten(0, 1), vout.flatten(0, 1), self.resize)
+        inseq = list(vin.unsqueeze(1))
+        tgseq = [ self.format_target(t) for t in vout.unflatten(0, (nbf, nbc)) ]
+        return inseq, tgseq
 
     @property
     def nb_sequences(self):
         return len(self.fnames)
 
 
+def _set_preloaded(dataset):
+    # Sent once per preloading process rather than with each index
+    global _preloaded
+    _preloaded = dataset
+
+def _preload_one(i):
+    volumes = _preloaded._load_volumes(*_preloaded._locate(i))
+    if _preloaded.cache.shared:
+        _preloaded.cache[i] = volumes
+        return i, None
+    return i, volumes
+
+
 class _ListHDFDataset(_HDFDataset):
     """ Load volume from HDF using specific architecture """
     def __init__(self, data_dir, hdfnames, resize="center-random", spatial_size=[128, 128, 128],
-                 norm="256", contrast=None, augmentation=False, cache=False):
+                 norm="256", contrast=None, augmentation=False, cache=False, **kwargs):
         # This dataset makes no sense if not multiclass, so we enforce it
         super(_ListHDFDataset, self).__init__(data_dir, hdfnames, multiclass=True,
                                               resize=resize, spatial_size=spatial_size,
                                               norm=norm, contrast=contrast,
-                                              augmentation=augmentation, cache=cache)
+                                              augmentation=augmentation, cache=cache,
+                                              **kwargs)
+        self.expansion["as_list"] = True
 
-    def get_volumes(self, i, iseq, iframe):
+    def get_volumes(self, i, iseq, iframe, transport=None, crops=None):
         # A bit lazy, but that will do
-        vin, vout = super().get_volumes(i, iseq, iframe)
+        samples = super().get_volumes(i, iseq, iframe, transport, crops)
+        if (transport or self.transport) == "compact": # Label map, expanded later
+            return samples
+        if (crops or self.crops_per_volume) == 1:
+            return samples[0], self.format_target(samples[1])
+        return [ (vin, self.format_target(vout)) for vin, vout in samples ]
+
+    def format_target(self, vout):
         vout = vout.to(torch.bool)
         # To ease the implementation, each target is returned as two channels
         # 1st element of vout is just background, don't keep it
         vout = TensorList(*[ torch.stack([~vout[k], vout[k]]) for k in range(1, len(vout)) ])
-        return vin, vout.to(torch.float)
+        return vout.to(torch.float)
@@ -2,15 +2,20 @@ from data.datasets.core import _HDFDataset, _ListHDFDataset
 
 
 
+def middle_frame(nbf):
+    # Not a lambda so datasets can be pickled for spawned workers
+    return int(nbf / 2)
+
+
 class FrameDataset(_HDFDataset):
     """ Load one specific frame per sequence of given HDF """
     def __init__(self, data_dir, hdfnames, frame_index=0, multiclass=False,
                  resize="center-random", spatial_size=[128, 128, 128],
-                 norm="256", contrast=None, augmentation=False, cache=True):
+                 norm="256", contrast=None, augmentation=False, cache=True, **kwargs):
+        self.frame_index = frame_index # Needed to preload
         super(FrameDataset, self).__init__(
                 data_dir, hdfnames, multiclass, resize, spatial_size, norm,
-                contrast, augmentation, cache)
-        self.frame_index = frame_index
+                contrast, augmentation, cache, **kwargs)
 
     def _get_frame_index(self, iseq):
         if callable(self.frame_index):
@@ -20,13 +25,17 @@ class FrameDataset(_HDFDataset):
 
     def get_sequence(self, iseq):
         # Mock sequence format to ease the callback process
-        inp, tg = self[iseq]
+        # Callbacks want dense volumes whatever the transport
+        inp, tg = self.get_volumes(iseq, iseq, self._get_frame_index(iseq), transport="dense",
+                                  crops=1)
         return [inp], [tg]
 
-    def __getitem__(self, i):
+    def _locate(self, i):
         # i = iseq in this case
-        iframe = self._get_frame_index(i)
-        return self.get_volumes(i, i, iframe)
+        return i, self._get_frame_index(i)
+
+    def __getitem__(self, i):
+        return self.get_volumes(i, *self._locate(i))
 
     def __len__(self):
         return len(self.fnames)
@@ -35,20 +44,20 @@ class MiddleFrameDataset(FrameDataset):
     """ AutoMVQ's reference frame is the middle one of the sequence """
     def __init__(self, data_dir, hdfnames, multiclass=False,
                  resize="center-random", spatial_size=[128, 128, 128],
-                 norm="256", contrast=None, augmentation=False, cache=True):
+                 norm="256", contrast=None, augmentation=False, cache=True, **kwargs):
         super(MiddleFrameDataset, self).__init__(
-                data_dir, hdfnames, lambda i: int(i / 2), multiclass, resize,
-                spatial_size, norm, contrast, augmentation, cache)
+                data_dir, hdfnames, middle_frame, multiclass, resize,
+                spatial_size, norm, contrast, augmentation, cache, **kwargs)
 
 
 class ListMiddleFrameDataset(_ListHDFDataset):
     """ AutoMVQ's reference frame is the middle one of the sequence """
     def __init__(self, data_dir, hdfnames, resize="center-random", spatial_size=[128, 128, 128],
-                 norm="256", contrast=None, augmentation=False, cache=True):
+                 norm="256", contrast=None, augmentation=False, cache=True, **kwargs):
+        self.frame_index = middle_frame # Needed to preload
         super(ListMiddleFrameDataset, self).__init__(
                 data_dir, hdfnames, resize, spatial_size, norm, contrast,
-                augmentation, cache)
-        self.frame_index = lambda i: int(i / 2)
+                augmentation, cache, **kwargs)
 
     def _get_frame_index(self, iseq):
         if callable(self.frame_index):
@@ -58,13 +67,17 @@ class ListMiddleFrameDataset(_ListHDFDataset):
 
     def get_sequence(self, iseq):
         # Mock sequence format to ease the callback process
-        inp, tg = self[iseq]
+        # Callbacks want dense volumes whatever the transport
+        inp, tg = self.get_volumes(iseq, iseq, self._get_frame_index(iseq), transport="dense",
+                                  crops=1)
         return [inp], [tg]
 
-    def __getitem__(self, i):
+    def _locate(self, i):
         # i = iseq in this case
-        iframe = self._get_frame_index(i)
-        return self.get_volumes(i, i, iframe)
+        return i, self._get_frame_index(i)
+
+    def __getitem__(self, i):
+        return self.get_volumes(i, *self._locate(i))
 
     def __len__(self):
         return len(self.fnames)
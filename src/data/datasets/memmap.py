@@ -0,0 +1,92 @@
+import numpy as np
+
+from torch import from_numpy as fnp
+
+from data.convert import INPUTS, LABELS, load_store_index
+from data.datasets.frames import FrameDataset, MiddleFrameDataset, ListMiddleFrameDataset
+from data.datasets.sequences import SequenceDataset, ListSequenceDataset
+from data.hdf import LEAFLETS
+from data.metadata import file_signature
+
+
+
+class _MemmapStore:
+    """
+    Read frames from a store written by `data.convert` instead of HDFs. Give the
+    store directory as `data_dir`. Pages are shared between all DataLoader
+    workers through the OS page cache, so there is little use for `cache`.
+    """
+    def _setup_paths(self):
+        self.store = self.prefixes[0]
+        self.store_index = load_store_index(self.store)
+        if self.store_index["labels"] != LEAFLETS:
+            raise ValueError(f"Store {self.store} packs leaflets as {self.store_index['labels']}, expected {LEAFLETS}.")
+        missing = [ f for f in self.fnames if f not in self.store_index["files"] ]
+        if missing:
+            raise FileNotFoundError(f"{len(missing)} file(s) not found in store {self.store}: {missing}")
+        self._arrays = None
+        # Files don't exist in store, but callbacks use paths' name for their output
+        return [ self.store.joinpath(f) for f in self.fnames ]
+
+    def _get_arrays(self):
+        # Map once per process, forked workers can keep parent's mapping
+        if self._arrays is None:
+            dtype = np.dtype(self.store_index["input_dtype"])
+            # Copy-on-write so torch gets a writable array, nothing is copied until written
+            self._arrays = (np.memmap(self.store.joinpath(INPUTS), dtype=dtype, mode='c'),
+                            np.memmap(self.store.joinpath(LABELS), dtype=np.uint8, mode='c'))
+        return self._arrays
+
+    def __getstate__(self):
+        # Pickling a memmap copies it, let spawned workers map the file themselves
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def _load_volumes(self, iseq, iframe):
+        # Store already has the compact format used by `_HDFDataset`
+        inputs, labels = self._get_arrays()
+        entry = self.store_index["files"][self.fnames[iseq]]
+        size = int(np.prod(entry["shape"]))
+        start = entry["offset"] + iframe * size
+        vin = fnp(inputs[start:start + size].reshape(entry["shape"]))
+        label = fnp(labels[start:start + size].reshape(entry["shape"]))
+        return vin, label
+
+    def _load_window(self, iseq, iframe):
+        # Slicing views only touches pages of the window
+        vin, label = self._load_volumes(iseq, iframe)
+        slices = self._window(iseq, iframe, vin.shape, lambda: label)
+        return vin[slices], label[slices]
+
+    def _load_sequence(self, iseq):
+        # Frames of a sequence are contiguous in the store
+        inputs, labels = self._get_arrays()
+        entry = self.store_index["files"][self.fnames[iseq]]
+        size, shape = int(np.prod(entry["shape"])), (entry["nbf"], *entry["shape"])
+        start, stop = entry["offset"], entry["offset"] + entry["nbf"] * size
+        return fnp(inputs[start:stop].reshape(shape)), fnp(labels[start:stop].reshape(shape))
+
+    def _source_signature(self, iseq):
+        # Files only exist in the store
+        return file_signature(self.store.joinpath(INPUTS))
+
+    def get_voxinfo(self, iseq):
+        entry = self.store_index["files"][self.fnames[iseq]]
+        return tuple(np.array(entry[k]) for k in ("origin", "directions", "resolution"))
+
+
+class MemmapFrameDataset(_MemmapStore, FrameDataset):
+    """ Same as `FrameDataset` but read from memory-mapped store """
+
+class MemmapMiddleFrameDataset(_MemmapStore, MiddleFrameDataset):
+    """ Same as `MiddleFrameDataset` but read from memory-mapped store """
+
+class ListMemmapMiddleFrameDataset(_MemmapStore, ListMiddleFrameDataset):
+    """ Same as `ListMiddleFrameDataset` but read from memory-mapped store """
+
+class MemmapSequenceDataset(_MemmapStore, SequenceDataset):
+    """ Same as `SequenceDataset` but read from memory-mapped store """
+
+class ListMemmapSequenceDataset(_MemmapStore, ListSequenceDataset):
+    """ Same as `ListSequenceDataset` but read from memory-mapped store """
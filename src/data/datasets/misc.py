@@ -1,21 +1,45 @@
+import time
 import torch
 
 from torch.utils.data import Dataset
 
+from data.augmentations import BatchAugmentation
+from data.synthetic import GENERATORS, burn
+
 
 
 class DummyDataset(Dataset):
+    """
+    Samples generated when asked, from their index and `seed` only, so memory
+    doesn't depend on `nb_dummies`. `content` is "noise" or "leaflets" (see
+    `data.synthetic`). `sleep` (seconds) and `compute` (smoothing passes)
+    make each sample slower to get, to mimic I/O or CPU bound loading.
+    """
     def __init__(self, nb_dummies, spatial_size=[128, 128, 128],
-                 multiclass=False, **kwargs):
+                 multiclass=False, content="noise", seed=0, sleep=0, compute=0,
+                 augmentation=False, **kwargs):
         # Accept kwargs in case default config pass arguments from regular dataset
-        self.inputs = torch.rand(nb_dummies, *spatial_size).to(torch.float)
-        nc = 3 if multiclass else 2
-        self.outputs = torch.randint(0, 2, (nb_dummies, nc, *spatial_size)).to(torch.float)
+        if content not in GENERATORS:
+            raise ValueError(f"Unknown content {content}. Chose from {list(GENERATORS.keys())}.")
+        self.spatial_size = spatial_size
         self.multiclass = multiclass
         self.nb_dummies = nb_dummies
+        self.generate = GENERATORS[content]
+        self.seed = seed
+        self.sleep, self.compute = sleep, compute
+        # Only batch augmentations, to benchmark them, see `data.augmentations`
+        self.batch_augmentation = BatchAugmentation() if augmentation == "batch" else None
 
     def __getitem__(self, i):
-        return self.inputs[i].unsqueeze(0), self.outputs[i]
+        if not 0 <= i < self.nb_dummies:
+            raise IndexError(f"Index {i} out of range for {self.nb_dummies} dummies.")
+        generator = torch.Generator()
+        # Tuples of ints hash the same in every process
+        generator.manual_seed(hash((self.seed, i)) & (2**63 - 1))
+        if self.sleep:
+            time.sleep(self.sleep)
+        vin, vout = self.generate(generator, self.spatial_size, self.multiclass)
+        return burn(vin, self.compute), vout
 
     def __len__(self):
         return self.nb_dummies
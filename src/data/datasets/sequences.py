@@ -6,24 +6,17 @@ class SequenceDataset(_HDFDataset):
     """ Load all frames of given sequences """
     def __init__(self, data_dir, hdfnames, multiclass=False,
                  resize="center-random", spatial_size=[128, 128, 128],
-                 norm="256", contrast=None, augmentation=False, cache=False):
+                 norm="256", contrast=None, augmentation=False, cache=False, **kwargs):
         super(SequenceDataset, self).__init__(
                 data_dir, hdfnames, multiclass, resize, spatial_size, norm,
-                contrast, augmentation, cache)
+                contrast, augmentation, cache, **kwargs)
 
-    def __getitem__(self, i):
+    def _locate(self, i):
         iseq = self.sequence_indexes[i]
-        iframe = i - self.cumulative_nbf[iseq]
-        return self.get_volumes(i, iseq, iframe)
-
-    def get_sequence(self, iseq):
-        # Get all frames from a specific sequence at once
-        inseq, tgseq = [], []
-        nbf = self.cumulative_nbf[iseq + 1] - self.cumulative_nbf[iseq]
-        for iframe in range(nbf):
-            inp, tg = self[iseq + iframe] #?
-            inseq.append(inp), tgseq.append(tg)
-        return inseq, tgseq
+        return iseq, i - self.cumulative_nbf[iseq]
+
+    def __getitem__(self, i):
+        return self.get_volumes(i, *self._locate(i))
 
     def __len__(self):
         return len(self.sequence_indexes)
@@ -32,24 +25,17 @@ class SequenceDataset(_HDFDataset):
 class ListSequenceDataset(_ListHDFDataset):
     def __init__(self, data_dir, hdfnames, resize="center-random",
                  spatial_size=[128, 128, 128], norm="256", contrast=None,
-                 augmentation=False, cache=False):
+                 augmentation=False, cache=False, **kwargs):
         super(ListSequenceDataset, self).__init__(
                 data_dir, hdfnames, resize, spatial_size, norm, contrast,
-                augmentation, cache)
+                augmentation, cache, **kwargs)
 
-    def __getitem__(self, i):
+    def _locate(self, i):
         iseq = self.sequence_indexes[i]
-        iframe = i - self.cumulative_nbf[iseq]
-        return self.get_volumes(i, iseq, iframe)
-
-    def get_sequence(self, iseq):
-        # Get all frames from a specific sequence at once
-        inseq, tgseq = [], []
-        nbf = self.cumulative_nbf[iseq + 1] - self.cumulative_nbf[iseq]
-        for iframe in range(nbf):
-            inp, tg = self[iseq + iframe] #?
-            inseq.append(inp), tgseq.append(tg)
-        return inseq, tgseq
+        return iseq, i - self.cumulative_nbf[iseq]
+
+    def __getitem__(self, i):
+        return self.get_volumes(i, *self._locate(i))
 
     def __len__(self):
         return len(self.sequence_indexes)
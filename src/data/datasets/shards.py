@@ -0,0 +1,140 @@
+import math
+import monai.transforms as mt
+import multiprocessing as mp
+import random as rd
+import torch
+import torch.distributed as dist
+
+from itertools import cycle, islice
+from pathlib import Path
+from torch import from_numpy as fnp
+from torch.utils.data import IterableDataset, get_worker_info
+
+from data.augmentations import BatchAugmentation
+from data.hdf import LEAFLETS
+from data.shards import load_shard_index, read_samples
+from data.transforms import NORMS, RESIZE, augmentations, decode_labels
+
+
+
+class ShardDataset(IterableDataset):
+    """
+    Stream the frames of set `subset` from shards written by `data.shards`
+    (give their directory as `data_dir`), each shard being read from start to
+    end. With `shuffle`, shards are shuffled every epoch and samples go
+    through a buffer of `buffer_size` frames drawn from at random. Shards are
+    dealt between processes (ranks) then DataLoader workers; all ranks give
+    the same number of samples, some being repeated if needed. Use it with
+    `data.loaders.EpochDataLoader` so it knows the epoch.
+    """
+    def __init__(self, data_dir, subset="train", multiclass=False, resize="center-random",
+                 spatial_size=[128, 128, 128], norm="256", contrast=None, augmentation=False,
+                 shuffle=True, buffer_size=16, seed=0, num_replicas=None, rank=None):
+        super(ShardDataset, self).__init__()
+        self.prefix = Path(data_dir).expanduser()
+        index = load_shard_index(self.prefix)
+        if index["labels"] != LEAFLETS:
+            raise ValueError(f"Shards {self.prefix} pack leaflets as {index['labels']}, expected {LEAFLETS}.")
+        self.shards = [ (s["shard"], len(s["samples"])) for s in index["sets"][subset] ]
+        if not self.shards:
+            raise ValueError(f"No shard of {subset} set in {self.prefix}.")
+        self.multiclass = multiclass
+        keys = ["in", "out"]
+        self.resize = RESIZE[resize](keys, spatial_size, multiclass=multiclass)
+        self.norm = NORMS[norm]
+        self.contrast = mt.AdjustContrast(contrast) if contrast is not None else contrast
+        # With "batch", batches are augmented once collated instead, see `data.augmentations`
+        self.batch_augmentation = BatchAugmentation() if augmentation == "batch" else None
+        self.augmentation = augmentations(keys) \
+                                if augmentation and self.batch_augmentation is None else False
+        self.shuffle, self.buffer_size, self.seed = shuffle, buffer_size, seed
+        # Resolved when iterating, process group may not exist yet
+        self.num_replicas, self.rank = num_replicas, rank
+        # Shared with workers, so `set_epoch` in main process reaches them
+        self._epoch = mp.RawValue('q', 0)
+
+    @property
+    def epoch(self):
+        return self._epoch.value
+
+    def set_epoch(self, epoch):
+        self._epoch.value = epoch
+
+    def _replicas(self):
+        distributed = dist.is_available() and dist.is_initialized()
+        replicas = self.num_replicas or (dist.get_world_size() if distributed else 1)
+        rank = self.rank if self.rank is not None else (dist.get_rank() if distributed else 0)
+        return replicas, rank
+
+    def _deal(self, epoch, replicas):
+        # Shards of each rank, to the least loaded one so ranks get about as many samples
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            rd.Random(self.seed + epoch).shuffle(order)
+        ranks, loads = [ [] for _ in range(replicas) ], [ 0 ] * replicas
+        for s in order:
+            r = loads.index(min(loads))
+            ranks[r].append(s)
+            loads[r] += self.shards[s][1]
+        return ranks
+
+    def _quotas(self, shards, nbw, replicas):
+        # Samples given by each worker: all of their shards', trimmed from the
+        # last workers or padded by the first one to the same total on all ranks
+        quotas = [ sum(self.shards[s][1] for s in shards[w::nbw]) for w in range(nbw) ]
+        excess = sum(quotas) - len(self)
+        for w in reversed(range(nbw)):
+            cut = min(quotas[w], max(excess, 0))
+            quotas[w], excess = quotas[w] - cut, excess - cut
+        quotas[0] -= min(excess, 0)
+        return quotas
+
+    def _samples(self, shards):
+        for s in shards:
+            for key, vin, label in read_samples(self.prefix.joinpath(self.shards[s][0])):
+                yield fnp(vin), fnp(label)
+
+    def _buffered(self, samples, rng):
+        # Keep `buffer_size` samples, give a random one each time a new one comes
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            k = rng.randrange(self.buffer_size)
+            yield buffer[k]
+            buffer[k] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _expand(self, vin, label):
+        # Same as `_HDFDataset.get_volumes` with dense transport
+        vin = self.norm(vin.unsqueeze(0))
+        if self.contrast is not None:
+            vin = self.contrast(vin)
+        data = {"in": vin, "out": decode_labels(label, self.multiclass).to(torch.float)}
+        if self.augmentation:
+            data = mt.apply_transform(self.augmentation, data)
+        data = mt.apply_transform(self.resize, data)
+        return data["in"], data["out"]
+
+    def __iter__(self):
+        replicas, rank = self._replicas()
+        info = get_worker_info()
+        nbw, wid = (1, 0) if info is None else (info.num_workers, info.id)
+        epoch = self.epoch
+        shards = self._deal(epoch, replicas)[rank]
+        if not shards:
+            raise ValueError(f"Fewer shards than the {replicas} processes, pack them smaller.")
+        mine = shards[wid::nbw] or shards # Padding may need more than own shards
+        quota = self._quotas(shards, nbw, replicas)[wid]
+        samples = islice(self._samples(cycle(mine)), quota)
+        if self.shuffle and self.buffer_size > 1:
+            samples = self._buffered(samples, rd.Random(hash((self.seed, epoch, rank, wid))))
+        for vin, label in samples:
+            yield self._expand(vin, label)
+
+    def __len__(self):
+        # Samples given by each rank, whatever the epoch
+        replicas, _ = self._replicas()
+        return math.ceil(sum(nb for _, nb in self.shards) / replicas)
@@ -0,0 +1,93 @@
+import monai.transforms as mt
+import torch
+import torch.distributed as dist
+
+from pathlib import Path
+from torch import from_numpy as fnp
+from torch.utils.data import IterableDataset, get_worker_info
+
+from data.hdf import HDFHandlePool, ReadBuffers, read_labels, read_volume
+from data.transforms import NORMS, RESIZE, decode_labels
+
+
+
+def list_sources(sources):
+    """
+    HDFs from directories (all `.h5` inside) or manifests (one path per line,
+    relative to the manifest's directory, `#` for comments)
+    """
+    sources = sources if isinstance(sources, (list, tuple)) else [ sources ]
+    paths = []
+    for src in map(lambda s: Path(s).expanduser().resolve(), sources):
+        if src.is_dir():
+            paths += sorted(f for f in src.iterdir() if f.suffix == ".h5")
+        elif src.is_file():
+            with open(src, 'r') as fd:
+                lines = [ l.split('#')[0].strip() for l in fd ]
+            paths += [ src.parent.joinpath(l) for l in lines if l ]
+        else:
+            raise FileNotFoundError(f"No directory nor manifest at {src}.")
+    return paths
+
+
+class HDFStreamDataset(IterableDataset):
+    """
+    Stream frames of HDFs from `sources` (see `list_sources`), no data split
+    nor frame counts needed. Files are dealt between processes (ranks) then
+    between DataLoader workers. Items are (input, target, metadata), or
+    (input, metadata) without `targets`, metadata being the file, frame index
+    and `VolumeGeometry`. Batch them with `data.collates.collate_stream`.
+    """
+    def __init__(self, sources, resize="center", spatial_size=[128, 128, 128], norm="256",
+                 contrast=None, multiclass=False, targets=True, frame_index=None,
+                 max_open_files=16, num_replicas=None, rank=None):
+        super(HDFStreamDataset, self).__init__()
+        self.paths = list_sources(sources)
+        keys = ["in", "out"] if targets else ["in"]
+        self.resize = RESIZE[resize](keys, spatial_size, multiclass=multiclass)
+        self.norm = NORMS[norm]
+        self.contrast = mt.AdjustContrast(contrast) if contrast is not None else contrast
+        self.multiclass = multiclass
+        self.targets = targets
+        self.frame_index = frame_index # All frames if None
+        # Same reads as map-style datasets, see `data.hdf`
+        self.handles = HDFHandlePool(max_open_files)
+        self.buffers = ReadBuffers()
+        # Resolved when iterating, process group may not exist yet
+        self.num_replicas, self.rank = num_replicas, rank
+
+    def _shard(self):
+        distributed = dist.is_available() and dist.is_initialized()
+        replicas = self.num_replicas or (dist.get_world_size() if distributed else 1)
+        rank = self.rank if self.rank is not None else (dist.get_rank() if distributed else 0)
+        info = get_worker_info()
+        nbw, wid = (1, 0) if info is None else (info.num_workers, info.id)
+        return self.paths[rank * nbw + wid::replicas * nbw]
+
+    def _frames(self, nbf):
+        if self.frame_index is None:
+            return range(nbf)
+        return [ self.frame_index(nbf) if callable(self.frame_index) else self.frame_index ]
+
+    def _read(self, hdf, iframe):
+        iframe += 1 # Indexes start at 1 in HDF
+        vin = self.norm(fnp(read_volume(hdf["CartesianVolume"][f"vol{iframe:02d}"])).unsqueeze(0))
+        if self.contrast is not None:
+            vin = self.contrast(vin)
+        if not self.targets:
+            return self.resize({"in": vin})["in"], None
+        label = read_labels(hdf["GroundTruth"][f"anterior-{iframe:02d}"],
+                            hdf["GroundTruth"][f"posterior-{iframe:02d}"], self.buffers)
+        data = self.resize({"in": vin, "out": decode_labels(fnp(label), self.multiclass).to(torch.float)})
+        return data["in"], data["out"]
+
+    def __iter__(self):
+        for path in self._shard():
+            with self.handles.open(path) as hdf:
+                geometry = hdf["VolumeGeometry"]
+                nbf = int(geometry["frameNumber"][()])
+                info = { k: geometry[k][()] for k in ("origin", "directions", "resolution") }
+                for iframe in self._frames(nbf):
+                    vin, vout = self._read(hdf, iframe)
+                    meta = {"path": str(path), "fname": path.name, "iframe": iframe, "nbf": nbf, **info}
+                    yield (vin, meta) if vout is None else (vin, vout, meta)
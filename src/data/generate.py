@@ -0,0 +1,101 @@
+"""
+Write a corpus of synthetic HDFs (see `data.synthetic`) laid out as echovox's,
+to benchmark the whole loading pipeline without patient data. Run as
+`python -m data.generate`.
+"""
+
+import click as cli
+import h5py
+import numpy as np
+import torch
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from data.metadata import scan_directory, write_metadata
+from data.preprocess import split_data, write_split
+from data.rechunk import CODECS, _storage, parse_chunks
+from data.synthetic import leaflet_masks, speckle
+
+
+
+def write_hdf(fname, seed, nbf, spatial_size, chunks=None, codec="none", level=4):
+    """ Sequence of `nbf` synthetic frames, in echovox's layout """
+    storage = _storage(spatial_size, chunks, codec, level)
+    with h5py.File(fname, 'w') as hdf:
+        volumes, truths = hdf.create_group("CartesianVolume"), hdf.create_group("GroundTruth")
+        for iframe in range(nbf):
+            generator = torch.Generator()
+            generator.manual_seed(hash((seed, iframe)) & (2**63 - 1))
+            ant, post = leaflet_masks(generator, spatial_size)
+            vin = speckle(generator, (ant, post), spatial_size)
+            # Indexes start at 1 in HDF
+            volumes.create_dataset(f"vol{iframe + 1:02d}", data=(vin[0] * 255).to(torch.uint8).numpy(), **storage)
+            truths.create_dataset(f"anterior-{iframe + 1:02d}", data=ant.numpy().astype(np.uint8), **storage)
+            truths.create_dataset(f"posterior-{iframe + 1:02d}", data=post.numpy().astype(np.uint8), **storage)
+        geometry = hdf.create_group("VolumeGeometry")
+        geometry.create_dataset("frameNumber", data=nbf)
+        geometry.create_dataset("origin", data=np.zeros(3))
+        geometry.create_dataset("directions", data=np.eye(3))
+        geometry.create_dataset("resolution", data=np.full(3, 0.6))
+    return fname
+
+def _write(args):
+    return write_hdf(*args)
+
+def _parse_range(value):
+    """ "12" -> (12, 12), "10,20" -> (10, 20) """
+    bounds = [ int(v) for v in value.split(',') ]
+    return bounds[0], bounds[-1]
+
+
+@cli.command(context_settings={"help_option_names": ["-h", "--help"],
+                               "show_default": True})
+@cli.argument("pout", type=cli.Path(resolve_path=True, file_okay=False, path_type=Path))
+@cli.option("--files", "-n", "nb_files", type=cli.IntRange(min=1), default=20,
+            help="Number of HDFs (sequences) to write.")
+@cli.option("--frames", "-f", default="10,20",
+            help="Frames per sequence, a number or a 'min,max' range drawn from per file.")
+@cli.option("--size", "-s", default="128",
+            help="Volumes' shape, one size for all dimensions or comma separated sizes.")
+@cli.option("--chunks", "-c", default="none",
+            help="Chunk shape, one size for all dimensions, comma separated sizes, or 'none'.")
+@cli.option("--codec", type=cli.Choice(CODECS), default="none", help="Compression filter.")
+@cli.option("--level", "-l", type=cli.IntRange(0, 9), default=4, help="Gzip level.")
+@cli.option("--train-ratio", "-tr", "rtrain", type=cli.FloatRange(0, 1), default=0.7,
+            help="Ratio of the files used for training dataset.")
+@cli.option("--validation-ratio", "-v", "rval", type=cli.FloatRange(0, 1), default=0.1,
+            help="Ratio of the files used for validation dataset.")
+@cli.option("--seed", type=int, default=0, help="Same seed, same files.")
+@cli.option("--workers", "-j", type=cli.IntRange(min=1), default=None, show_default=False,
+            help="Number of processes writing HDFs. [default: number of CPUs]")
+def main(pout, nb_files, frames, size, chunks, codec, level, rtrain, rval, seed, workers):
+    """
+    Write synthetic HDFs to POUT, laid out as echovox's. Also writes
+    POUT/data-split.yml and POUT/metadata.json as `data.preprocess` would.
+
+    POUT     DIR    Where to write the HDFs.
+    """
+    assert rtrain + rval <= 1, "Train and validation ratios must sum to at most 1."
+    chunks, spatial_size = parse_chunks(chunks), parse_chunks(size)
+    _storage((1, 1, 1), chunks, codec, level) # Fail early
+    pout.mkdir(parents=True, exist_ok=True)
+    low, high = _parse_range(frames)
+    nbfs = np.random.default_rng(seed).integers(low, high + 1, nb_files)
+    jobs = [ (pout.joinpath(f"synthetic-{i:05d}.h5"), (seed, i), int(nbf),
+              spatial_size, chunks, codec, level) for i, nbf in enumerate(nbfs) ]
+    with ProcessPoolExecutor(workers) as pool:
+        fnames = []
+        for fname in pool.map(_write, jobs):
+            fnames.append(fname)
+            print(f"Written {fname}")
+    metadata = scan_directory(fnames, workers)
+    print(f"Metadata available at {write_metadata(pout, metadata)}")
+    data = [ [fname, entry["nbf"]] for fname, entry in metadata.items() ]
+    write_split(split_data(data, rtrain, rval), pout.joinpath("data-split.yml"))
+    print(f"Split file available at {pout.joinpath('data-split.yml')}")
+
+
+
+if __name__ == "__main__":
+    main()
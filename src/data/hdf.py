@@ -0,0 +1,165 @@
+"""
+Helpers to read HDF files as produced by echovox
+"""
+
+import h5py
+import numpy as np
+import os
+import threading
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+
+
+
+
+# Both leaflets fit in one label map, one bit each (some voxels are in both)
+LEAFLETS = {"anterior": 1, "posterior": 2}
+
+
+
+def _selected_shape(dset, selection):
+    if selection is None:
+        return dset.shape
+    return tuple(len(range(*s.indices(n))) for s, n in zip(selection, dset.shape))
+
+def read_volume(dset, selection=None, out=None):
+    """ `dset[selection]` read straight into `out` (a new array if None) """
+    shape = _selected_shape(dset, selection)
+    out = np.empty(shape, dset.dtype) if out is None else out
+    if out.size > 0:
+        dset.read_direct(out, source_sel=selection)
+    return out
+
+def read_labels(ant, post, buffers, selection=None, out=None):
+    """
+    `data.transforms.encode_labels` of leaflets' datasets `ant` and `post`,
+    masks being read into scratch `buffers` (see `ReadBuffers`) and packed
+    into `out` (a new uint8 array if None) without other temporaries
+    """
+    shape = _selected_shape(ant, selection)
+    out = np.empty(shape, np.uint8) if out is None else out
+    out.fill(0)
+    flag = buffers.get("flag", shape, np.uint8)
+    for dset, bit in zip((ant, post), (LEAFLETS["anterior"], LEAFLETS["posterior"])):
+        mask = read_volume(dset, selection, out=buffers.get("mask", shape, dset.dtype))
+        np.not_equal(mask, 0, out=flag, casting="unsafe")
+        np.multiply(flag, bit, out=flag)
+        np.bitwise_or(out, flag, out=out)
+    return out
+
+
+class ReadBuffers:
+    """
+    Scratch arrays reused from one read to the next, one per thread and name,
+    grown to the largest shape asked for. They only hold data until the same
+    thread asks for the same name again, copy anything to keep.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # Thread locals can't be pickled, spawned workers start without buffers
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def get(self, name, shape, dtype):
+        buffers = self._local.__dict__.setdefault("buffers", {})
+        size, key = int(np.prod(shape)), (name, np.dtype(dtype))
+        if key not in buffers or buffers[key].size < size:
+            buffers[key] = np.empty(size, dtype)
+        return buffers[key][:size].reshape(shape)
+
+
+
+class HDFHandlePool:
+    """
+    LRU of opened `h5py.File`, meant to live inside each DataLoader worker.
+    Handles are never shared between processes: the pool notices it has been
+    forked (or unpickled by a spawned worker) and reopens files lazily.
+    Threads of a process can share it, handles in use are never closed.
+    """
+    def __init__(self, max_open_files=16):
+        self.max_open_files = max_open_files
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._handles = OrderedDict()
+        self._in_use = Counter()
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+        # `atexit` isn't called in DataLoader workers, multiprocessing finalizers are
+        self._finalizer = Finalize(self, HDFHandlePool._close_all, args=(self._handles,),
+                                   exitpriority=10)
+
+    @staticmethod
+    def _close_all(handles):
+        for hdf in handles.values():
+            try:
+                hdf.close()
+            except Exception: # Already closed or HDF5 library already torn down
+                pass
+        handles.clear()
+
+    def __getstate__(self):
+        # Opened files can't be pickled, spawned workers start with an empty pool
+        return {"max_open_files": self.max_open_files}
+
+    def __setstate__(self, state):
+        self.max_open_files = state["max_open_files"]
+        self._reset()
+
+    @contextmanager
+    def open(self, path):
+        """ Yield an opened handle on `path`, opening it only if needed """
+        if os.getpid() != self._pid:
+            # We've been forked, inherited handles belong to parent process.
+            # Cancel inherited finalizer so we don't close parent's files.
+            self._finalizer.cancel()
+            self._reset()
+        key = str(path)
+        if self.max_open_files <= 0: # Pooling disabled, behave like `h5py.File`
+            self.misses += 1
+            hdf = h5py.File(path, 'r')
+            try:
+                yield hdf
+            finally:
+                hdf.close()
+            return
+        with self._lock:
+            if key in self._handles:
+                self.hits += 1
+                self._handles.move_to_end(key)
+            else:
+                self.misses += 1
+                self._handles[key] = h5py.File(path, 'r')
+            hdf = self._handles[key]
+            self._in_use[key] += 1
+            self._evict()
+        try:
+            yield hdf
+        finally:
+            with self._lock:
+                self._in_use[key] -= 1
+                self._evict()
+
+    def _evict(self):
+        # Least recently used first, skip handles another thread is reading
+        for key in list(self._handles.keys()):
+            if len(self._handles) <= self.max_open_files:
+                break
+            if self._in_use[key] <= 0:
+                self._handles.pop(key).close()
+
+    def close(self):
+        self._finalizer() # Also unregister it
+        self._reset()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "open_files": len(self._handles),
+                "max_open_files": self.max_open_files}
@@ -0,0 +1,86 @@
+"""
+Voxel indices of each leaflet, so crops by classes don't scan label maps
+"""
+
+import hashlib
+import numpy as np
+import os
+import torch
+
+from pathlib import Path
+
+from data.hdf import LEAFLETS
+from data.metadata import file_signature
+
+
+
+def foreground_indices(label):
+    """ Flat int32 indices of each leaflet (and of any) in an `encode_labels` map """
+    flat = np.asarray(label).reshape(-1)
+    indices = { l: np.flatnonzero(flat & bit).astype(np.int32) for l, bit in LEAFLETS.items() }
+    indices["any"] = np.flatnonzero(flat).astype(np.int32)
+    return indices
+
+
+class ForegroundIndices:
+    """
+    `foreground_indices` of each frame, computed the first time it's seen and
+    kept in memory (per worker). With `sidecar_dir`, also saved there, one
+    file per frame, so workers and later runs don't have to compute them.
+    Saved ones are named after the full path of their file and thrown away
+    once said file changes.
+    """
+    def __init__(self, sidecar_dir=None):
+        self.sidecar_dir = None if sidecar_dir is None else Path(sidecar_dir).expanduser()
+        if self.sidecar_dir is not None:
+            self.sidecar_dir.mkdir(parents=True, exist_ok=True)
+        self._memory = {}
+
+    def _signature(self, path):
+        # Only HDFs change, store's files don't exist as such
+        try:
+            return file_signature(path)
+        except FileNotFoundError:
+            return None
+
+    def _sidecar(self, path, iframe):
+        # Files of different directories can share their name
+        digest = hashlib.sha1(str(Path(path).resolve()).encode()).hexdigest()[:12]
+        return self.sidecar_dir.joinpath(f"{Path(path).name}-{digest}-{iframe:02d}.npz")
+
+    def _load(self, fname, signature):
+        try:
+            with np.load(fname) as sidecar:
+                if signature is not None and (sidecar["size"], sidecar["mtime"]) \
+                        != (signature["size"], signature["mtime"]):
+                    return None # HDF changed since
+                return { k: sidecar[k] for k in (*LEAFLETS, "any") }
+        except (FileNotFoundError, KeyError, ValueError): # Missing or half written
+            return None
+
+    def _save(self, fname, indices, signature):
+        signature = signature or {"size": -1, "mtime": -1}
+        tmp = fname.with_name(f"{fname.name}.{os.getpid()}.tmp.npz")
+        np.savez(tmp, **indices, **signature)
+        os.replace(tmp, fname) # Other workers never see a partial file
+
+    def get(self, path, iframe, get_label, signature=None):
+        """
+        Indices of frame `iframe` of `path`, `get_label` gives its label map if
+        needed. `signature` is what `file_signature` gives for the file frames
+        are read from, looked up when not given.
+        """
+        key = (str(path), iframe)
+        if key in self._memory:
+            return self._memory[key]
+        indices, fname = None, None
+        if self.sidecar_dir is not None:
+            signature = signature or self._signature(path)
+            fname = self._sidecar(path, iframe)
+            indices = self._load(fname, signature)
+        if indices is None:
+            indices = foreground_indices(get_label())
+            if fname is not None:
+                self._save(fname, indices, signature)
+        self._memory[key] = { k: torch.from_numpy(v) for k, v in indices.items() }
+        return self._memory[key]
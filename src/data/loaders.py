@@ -1,9 +1,11 @@
 import torch
 
+from functools import partial
 from torch.utils.data import DataLoader
 
 from data.collates import *
 from data.datasets import *
+from data.samplers import FileLocalitySampler, PlannedSampler
 
 
 _datasets = {"DummyDataset": DummyDataset,
@@ -11,36 +13,125 @@ _datasets = {"DummyDataset": DummyDataset,
              "MiddleFrameDataset": MiddleFrameDataset,
              "ListMiddleFrameDataset": ListMiddleFrameDataset,
              "SequenceDataset": SequenceDataset,
-             "ListSequenceDataset": ListSequenceDataset}
+             "ListSequenceDataset": ListSequenceDataset,
+             "MemmapFrameDataset": MemmapFrameDataset,
+             "MemmapMiddleFrameDataset": MemmapMiddleFrameDataset,
+             "ListMemmapMiddleFrameDataset": ListMemmapMiddleFrameDataset,
+             "MemmapSequenceDataset": MemmapSequenceDataset,
+             "ListMemmapSequenceDataset": ListMemmapSequenceDataset}
+
+_streams = {"HDFStreamDataset": HDFStreamDataset}
+
+_shards = {"ShardDataset": ShardDataset}
 
 _collates = {"collate_tensorlist": collate_tensorlist}
 
+_samplers = {"PlannedSampler": PlannedSampler,
+             "FileLocalitySampler": FileLocalitySampler}
+
+
+
+class EpochDataLoader(DataLoader):
+    """
+    Tell its dataset each epoch (`set_epoch`) before iterating it, as Lightning
+    does for samplers, for iterable datasets shuffling themselves
+    """
+    def __init__(self, *args, **kwargs):
+        super(EpochDataLoader, self).__init__(*args, **kwargs)
+        self._epochs = 0
+
+    def __iter__(self):
+        self.dataset.set_epoch(self._epochs)
+        self._epochs += 1
+        return super(EpochDataLoader, self).__iter__()
 
 
+def _transport_collate(dataset, collate_fn):
+    if getattr(dataset, "transport", "dense") == "compact":
+        # Whatever the dataset, batches are raw volumes and label maps
+        return partial(collate_compact, spec=dataset.expansion)
+    return collate_fn
+
+def _crops_collate(dataset, collate_fn):
+    if getattr(dataset, "crops_per_volume", 1) > 1:
+        # Items are lists of crops, flatten them before collating
+        return partial(collate_crops, collate_fn=collate_fn)
+    return collate_fn
+
+def _augment_collate(dataset, collate_fn):
+    augment = getattr(dataset, "batch_augmentation", None)
+    if augment is not None:
+        # Training batches only, other sets don't augment
+        return partial(collate_augmented, augment=augment, collate_fn=collate_fn)
+    return collate_fn
+
+def _sampling(dataset, shuffle, batch_size, sampler=None):
+    readahead = getattr(dataset, "readahead", None)
+    if sampler is None:
+        if readahead is None:
+            return {"shuffle": shuffle}
+        # Reading ahead needs to know the order of samples beforehand
+        sampler = {"name": "PlannedSampler"}
+    kwsampler = dict(sampler)
+    sampler = _samplers[kwsampler.pop("name")](dataset, shuffle=shuffle, **kwsampler)
+    if readahead is not None:
+        readahead.attach(sampler, batch_size)
+    return {"sampler": sampler}
+
 def load_data(name, test=False, **kwargs):
     kwdataset = kwargs.pop("dataset")
     collate_fn = _collates.get(kwargs.pop("collate_fn", None), None)
+    sampler = kwargs.pop("sampler", None) # Only used for training
+    if name in _streams: # Whole directories, no split
+        if not test:
+            raise ValueError(f"{name} is meant for inference, only use it to test.")
+        kwdataset.pop("files", None)
+        kwdataset.pop("augmentation", None)
+        stream = _streams[name](kwdataset.pop("prefix"), **kwdataset)
+        return DataLoader(stream, **kwargs, collate_fn=collate_stream)
+    if name in _shards: # Sets already packed, see `data.shards`
+        prefix = kwdataset.pop("prefix")
+        kwdataset.pop("files", None)
+        if test:
+            kwdataset.update(resize="center", augmentation=False, shuffle=False)
+            testset = _shards[name](prefix, "test", **kwdataset)
+            return EpochDataLoader(testset, **kwargs, collate_fn=collate_fn)
+        trainset = _shards[name](prefix, "train", **kwdataset)
+        kwdataset.update(resize="center", augmentation=False, shuffle=False)
+        valset = _shards[name](prefix, "validation", **kwdataset)
+        return EpochDataLoader(trainset, **kwargs, collate_fn=_augment_collate(trainset, collate_fn)), \
+               EpochDataLoader(valset, **kwargs, collate_fn=collate_fn)
     if name == "DummyDataset": # Debug case
         nb_dummies = kwdataset.pop("nb_dummies", 10)
+        seed = kwdataset.pop("seed", 0) # Other seeds so sets don't share samples
         if test:
-            testset = DummyDataset(3, **kwdataset)
+            testset = DummyDataset(3, seed=seed + 2, **kwdataset)
             return DataLoader(testset, **kwargs)
         else:
-            trainset = DummyDataset(nb_dummies, **kwdataset)
-            valset = DummyDataset(3, **kwdataset)
+            trainset = DummyDataset(nb_dummies, seed=seed, **kwdataset)
+            valset = DummyDataset(3, seed=seed + 1, **kwdataset)
     else: # Usual case
         dataset = _datasets[name]
         prefix, files = kwdataset.pop("prefix"), kwdataset.pop("files")
         if test:
             # Fix non-random values outside training
             kwdataset["resize"], kwdataset["augmentation"] = "center", False
+            kwdataset.pop("crops_per_volume", None) # Center crops would all be the same
             testset = dataset(prefix, files["test"]["files"], **kwdataset)
-            return DataLoader(testset, **kwargs, collate_fn=collate_fn)
+            collate_fn = _transport_collate(testset, collate_fn)
+            return DataLoader(testset, **kwargs, collate_fn=collate_fn,
+                              **_sampling(testset, False, kwargs.get("batch_size", 1)))
         else:
             trainset = dataset(prefix, files["train"]["files"], **kwdataset)
             # Fix non-random values outside training
             kwdataset["resize"], kwdataset["augmentation"] = "center", False
+            kwdataset.pop("crops_per_volume", None)
             valset = dataset(prefix, files["validation"]["files"], **kwdataset)
-    trainloader = DataLoader(trainset, shuffle=True, **kwargs, collate_fn=collate_fn)
-    valloader = DataLoader(valset, **kwargs, collate_fn=collate_fn)
+            collate_fn = _transport_collate(trainset, collate_fn)
+    batch_size = kwargs.get("batch_size", 1)
+    train_collate = _augment_collate(trainset, _crops_collate(trainset, collate_fn))
+    trainloader = DataLoader(trainset, **kwargs, collate_fn=train_collate,
+                             **_sampling(trainset, True, batch_size, sampler))
+    valloader = DataLoader(valset, **kwargs, collate_fn=collate_fn,
+                           **_sampling(valset, False, batch_size))
     return trainloader, valloader
@@ -0,0 +1,86 @@
+"""
+Sidecar index of what's inside HDFs, so nobody has to open them to know it.
+Written by `data.preprocess` next to the HDFs.
+"""
+
+import h5py
+import json
+import numpy as np
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from data.hdf import LEAFLETS
+
+
+
+METADATA = "metadata.json"
+
+
+
+def _layout(dset):
+    # How a dataset is stored, chunks are None if contiguous
+    return {"shape": list(dset.shape), "dtype": dset.dtype.str,
+            "chunks": None if dset.chunks is None else list(dset.chunks),
+            "compression": dset.compression, "compression_opts": dset.compression_opts}
+
+def _bbox(mask):
+    # Inclusive [[xmin, ymin, zmin], [xmax, ymax, zmax]], None if empty
+    if not mask.any():
+        return None
+    ranges = [ np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != k)))
+                for k in range(mask.ndim) ]
+    return [ [ int(r[0]) for r in ranges ], [ int(r[-1]) for r in ranges ] ]
+
+def file_signature(path):
+    """ Cheap way to tell a file changed """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def scan_hdf(path):
+    """ Everything worth knowing about an echovox HDF """
+    path = Path(path)
+    entry = file_signature(path)
+    with h5py.File(path, 'r') as hdf:
+        geometry = hdf["VolumeGeometry"]
+        entry["nbf"] = int(geometry["frameNumber"][()])
+        entry.update({ k: geometry[k][()].tolist() for k in ("origin", "directions", "resolution") })
+        entry["frames"] = []
+        for iframe in range(1, entry["nbf"] + 1):
+            frame = {"input": _layout(hdf["CartesianVolume"][f"vol{iframe:02d}"]),
+                     "leaflets": {}}
+            for leaflet in LEAFLETS:
+                dset = hdf["GroundTruth"][f"{leaflet}-{iframe:02d}"]
+                mask = dset[()] != 0
+                frame["leaflets"][leaflet] = {"layout": _layout(dset), "count": int(mask.sum()),
+                                              "bbox": _bbox(mask)}
+            entry["frames"].append(frame)
+    return entry
+
+def scan_directory(paths, workers=None):
+    """ `scan_hdf` all `paths` in parallel, keyed by file name """
+    paths = list(paths)
+    with ProcessPoolExecutor(workers) as pool:
+        entries = pool.map(scan_hdf, paths)
+        return { p.name: e for p, e in zip(paths, entries) }
+
+def write_metadata(pdata, entries, fname=None):
+    fname = Path(pdata).joinpath(METADATA) if fname is None else Path(fname)
+    with open(fname, 'w') as fd:
+        json.dump({"labels": LEAFLETS, "files": entries}, fd)
+    return fname
+
+def load_metadata(fname):
+    with open(fname, 'r') as fd:
+        metadata = json.load(fd)
+    if metadata["labels"] != LEAFLETS:
+        raise ValueError(f"{fname} describes leaflets {metadata['labels']}, expected {LEAFLETS}.")
+    return metadata["files"]
+
+def is_stale(entry, path):
+    """ Whether `path` changed since `entry` was scanned """
+    try:
+        return file_signature(path) != {k: entry[k] for k in ("size", "mtime")}
+    except FileNotFoundError:
+        return True
@@ -0,0 +1,120 @@
+"""
+Read samples before they're asked for, so I/O overlaps with the rest of the work
+"""
+
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.util import Finalize
+from torch.utils.data import get_worker_info
+
+
+
+class ReadAhead:
+    """
+    Guess which indexes the current DataLoader worker will be asked next and
+    read up to `depth` of them on `threads` threads. Guesses come from a
+    `data.samplers.PlannedSampler` given to `attach`, without one samples are
+    read on demand. Only active in workers.
+    h5py runs one call at a time (its global lock) and decompresses holding
+    the GIL, so reads only overlap with Python work of the worker and waiting
+    for storage, e.g. slow disks or `partial_reads`. Decompression bound
+    reads gain nothing, add DataLoader workers instead.
+    """
+    def __init__(self, depth=4, threads=2):
+        self.depth = depth
+        self.threads = threads
+        self.sampler, self.batch_size = None, 1
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._pool, self._pending = None, {} # Index -> Future
+        self._plan = (None, [], {}) # Epoch, order of indexes, their position
+        self.hits, self.misses, self.issued, self.wasted = 0, 0, 0, 0
+        self.requests, self.total_depth, self.max_depth = 0, 0, 0
+
+    def __getstate__(self):
+        # Threads and pending reads stay in their process
+        return {"depth": self.depth, "threads": self.threads,
+                "sampler": self.sampler, "batch_size": self.batch_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def attach(self, sampler, batch_size=1):
+        """ `sampler` and `batch_size` of the DataLoader using the dataset """
+        self.sampler, self.batch_size = sampler, batch_size or 1
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.threads, thread_name_prefix="readahead")
+            Finalize(self, ReadAhead._shutdown, args=(self._pool, self._pending),
+                     exitpriority=10)
+        return self._pool
+
+    @staticmethod
+    def _shutdown(pool, pending):
+        for future in pending.values():
+            future.cancel()
+        pool.shutdown(wait=False)
+
+    def _positions(self):
+        epoch = self.sampler.epoch
+        if self._plan[0] != epoch:
+            plan = self.sampler.plan(epoch)
+            self._plan = (epoch, plan, { i: p for p, i in enumerate(plan) })
+        return self._plan[1:]
+
+    def upcoming(self, i):
+        """ Indexes this worker should be asked for after `i` """
+        plan, positions = self._positions()
+        if i not in positions:
+            return []
+        info = get_worker_info()
+        nbw = 1 if info is None else info.num_workers
+        # Workers are given whole batches in turn, after batch b we get b + nbw
+        ibatch = positions[i] // self.batch_size
+        start, upcoming = positions[i] + 1, []
+        while len(upcoming) < self.depth and start < len(plan):
+            upcoming += plan[start:(ibatch + 1) * self.batch_size]
+            ibatch += nbw
+            start = ibatch * self.batch_size
+        return upcoming[:self.depth]
+
+    def fetch(self, i, load, skip=None):
+        """
+        Get sample `i` with `load(i)`, or from a previous read ahead, then read
+        what comes next unless `skip(index)` (e.g. already cached)
+        """
+        if self.depth <= 0 or self.sampler is None or get_worker_info() is None:
+            return load(i)
+        if os.getpid() != self._pid: # Forked, parent's threads didn't follow
+            self._reset()
+        in_flight = sum(not f.done() for f in self._pending.values())
+        self.requests += 1
+        self.total_depth += in_flight
+        self.max_depth = max(self.max_depth, in_flight)
+        future = self._pending.pop(i, None)
+        upcoming = self.upcoming(i)
+        # Drop what we won't be asked for anymore, e.g. from previous epoch
+        for j in set(self._pending) - set(upcoming):
+            self._pending.pop(j).cancel()
+            self.wasted += 1
+        for j in upcoming:
+            if j not in self._pending and not (skip is not None and skip(j)):
+                self._pending[j] = self.pool.submit(load, j)
+                self.issued += 1
+        if future is None:
+            self.misses += 1
+            return load(i)
+        self.hits += 1
+        return future.result()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "issued": self.issued,
+                "wasted": self.wasted, "pending": len(self._pending),
+                "max_queue_depth": self.max_depth,
+                "mean_queue_depth": self.total_depth / max(self.requests, 1)}
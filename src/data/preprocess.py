@@ -4,17 +4,36 @@ train, validation, and test sets
 """
 
 import click as cli
-import h5py
 import random as rd
 import sys
 import yaml
 
 from pathlib import Path
 
+from data.metadata import METADATA, scan_directory, write_metadata
+
 rd.seed(42)
 
 
 
+def split_data(data, rtrain, rval):
+    """ Shuffle [file name, number of frames] pairs into train/validation/test sets """
+    data = list(data)
+    rd.shuffle(data)
+    nb = len(data)
+    tridx, validx = int(rtrain * nb), int((rtrain + rval) * nb)
+    train, val, test = data[:tridx], data[tridx:validx], data[validx:]
+    out = {"train": {"files": train, "total_frames": sum([t[1] for t in train])},
+           "validation": {"files": val, "total_frames": sum([t[1] for t in val])},
+           "test": {"files": test, "total_frames": sum([t[1] for t in test])}}
+    out["total_frames"] = sum([subout["total_frames"] for subout in out.values()])
+    return out
+
+def write_split(out, ofname):
+    with open(ofname, 'w') as fd:
+        #TODO? Order keys
+        yaml.dump(out, fd, default_flow_style=False)
+
 
 @cli.command(context_settings={"help_option_names": ["-h", "--help"],
                                "show_default": True})
@@ -29,43 +48,38 @@ rd.seed(42)
 @cli.option("--output", "-o", "ofname", show_default=False,
             type=cli.Path(writable=True, path_type=Path), default="data-split.yml",
             help="Where to save split and frames number. [default: PDATA/data-split.yml]")
-def build_dataset(pdata, rtrain, rval, rtest, ofname):
+@cli.option("--workers", "-j", type=cli.IntRange(min=1), default=None, show_default=False,
+            help="Number of processes scanning HDFs. [default: number of CPUs]")
+def build_dataset(pdata, rtrain, rval, rtest, ofname, workers):
     """
     Retrieve number of frames from each sequence (i.e. one HDF file) and split the
     whole data to train, validation, and test sets.\n
-    /!\ Split is performe accross sequences and not frames. /!\ 
+    /!\ Split is performe accross sequences and not frames. /!\ \n
+    Everything else learned while scanning files is saved in PDATA/metadata.json,
+    see `data.metadata`.
 
     PDATA    DIR     Path to directory containing data in HDF format.
     """
     assert (rtrain + rval + rtest) == 1, \
            "Train, validation and test ratios must sum to 1."
     out = {}
-    data = []
     # FIXME: This should not be needed
     pdata = Path(pdata.decode()) if isinstance(pdata, bytes) else pdata
     ofname = ofname.decode() if isinstance(ofname, bytes) else ofname
     ofname = ofname.resolve() if ("-o" in sys.argv[1:] or "--output" in sys.argv[1:]) \
                               else pdata.joinpath(ofname)
     #TODO? Pretty tqdm bar
+    fnames = []
     for fname in pdata.iterdir():
         if fname.suffix != ".h5":
-            print(f"Ignoring {fname.name}, not an HDF.")
+            if fname.name != METADATA:
+                print(f"Ignoring {fname.name}, not an HDF.")
             continue
-        hdf = h5py.File(fname, 'r')
-        data.append([fname.name, int(hdf["VolumeGeometry"]["frameNumber"][()])])
-        hdf.close()
-    # Split into train/validation/test sets
-    rd.shuffle(data)
-    nb = len(data)
-    tridx, validx = int(rtrain * nb), int((rtrain + rval) * nb)
-    train, val, test = data[:tridx], data[tridx:validx], data[validx:]
-    out = {"train": {"files": train, "total_frames": sum([t[1] for t in train])},
-           "validation": {"files": val, "total_frames": sum([t[1] for t in val])},
-           "test": {"files": test, "total_frames": sum([t[1] for t in test])}}
-    out["total_frames"] = sum([subout["total_frames"] for subout in out.values()])
-    with open(ofname, 'w') as fd:
-        #TODO? Order keys
-        yaml.dump(out, fd, default_flow_style=False)
+        fnames.append(fname)
+    metadata = scan_directory(fnames, workers)
+    data = [ [fname, entry["nbf"]] for fname, entry in metadata.items() ]
+    print(f"Metadata available at {write_metadata(pdata, metadata)}")
+    write_split(split_data(data, rtrain, rval), ofname)
     print(f"Split file available at {ofname}")
 
 
@@ -0,0 +1,185 @@
+"""
+Rewrite echovox HDFs with a chunking and compression suited to random crops,
+and measure which one suits your disks. Run as `python -m data.rechunk`.
+"""
+
+import click as cli
+import h5py
+import numpy as np
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from data.hdf import LEAFLETS
+
+
+
+CODECS = ["none", "lzf", "gzip"]
+# Volumes read by `_HDFDataset`, everything else is copied as is
+VOLUMES = ["CartesianVolume", "GroundTruth"]
+
+
+
+def parse_chunks(chunks):
+    """ "32" -> (32, 32, 32), "32,32,16" -> (32, 32, 16), "none" -> contiguous """
+    if chunks is None or chunks.lower() == "none":
+        return None
+    chunks = tuple(int(c) for c in chunks.split(','))
+    return chunks * 3 if len(chunks) == 1 else chunks
+
+def _storage(shape, chunks, codec, level):
+    if chunks is None and codec != "none":
+        raise ValueError("HDF5 can only compress chunked datasets, give `--chunks` too.")
+    kwargs = {}
+    if chunks is not None:
+        kwargs["chunks"] = tuple(min(c, s) for c, s in zip(chunks, shape))
+    if codec == "gzip":
+        kwargs.update(compression="gzip", compression_opts=level)
+    elif codec == "lzf":
+        kwargs["compression"] = "lzf"
+    return kwargs
+
+def rewrite_hdf(src, dst, chunks, codec="none", level=4):
+    """ Copy `src` to `dst`, volumes being stored with new `chunks` and `codec` """
+    src, dst = Path(src), Path(dst)
+    if dst.resolve() == src.resolve():
+        raise ValueError(f"Can't rewrite {src} onto itself.")
+    # Written aside then renamed, so `dst` is never left half written
+    tmp = dst.with_name(f".{dst.name}.{os.getpid()}.tmp")
+    try:
+        _copy_hdf(src, tmp, chunks, codec, level)
+        os.replace(tmp, dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+def _copy_hdf(src, dst, chunks, codec, level):
+    with h5py.File(src, 'r') as fin, h5py.File(dst, 'w') as fout:
+        fout.attrs.update(fin.attrs)
+        for gname, group in fin.items():
+            if gname not in VOLUMES or not isinstance(group, h5py.Group):
+                fin.copy(group, fout, name=gname)
+                continue
+            gout = fout.create_group(gname)
+            gout.attrs.update(group.attrs)
+            for name, dset in group.items():
+                out = gout.create_dataset(name, data=dset[()],
+                                          **_storage(dset.shape, chunks, codec, level))
+                out.attrs.update(dset.attrs)
+
+def _rewrite(args):
+    rewrite_hdf(*args)
+    return args[1]
+
+def rewrite_directory(pdata, pout, chunks, codec, level, workers=None, limit=None):
+    if Path(pout).resolve() == Path(pdata).resolve():
+        raise ValueError(f"Output directory {pout} is the input one, HDFs would be overwritten.")
+    fnames = sorted(f for f in Path(pdata).iterdir() if f.suffix == ".h5")[:limit]
+    Path(pout).mkdir(parents=True, exist_ok=True)
+    jobs = [ (f, Path(pout).joinpath(f.name), chunks, codec, level) for f in fnames ]
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(_rewrite, jobs))
+
+
+def benchmark_crops(fnames, crop, nb_crops, seed=0):
+    """ Read `nb_crops` random crops (input and labels) from random frames """
+    rng = np.random.default_rng(seed)
+    handles = [ h5py.File(f, 'r') for f in fnames ]
+    nbytes, start = 0, time.perf_counter()
+    for _ in range(nb_crops):
+        hdf = handles[rng.integers(len(handles))]
+        iframe = rng.integers(hdf["VolumeGeometry"]["frameNumber"][()]) + 1
+        names = [ f"CartesianVolume/vol{iframe:02d}" ] \
+                + [ f"GroundTruth/{l}-{iframe:02d}" for l in LEAFLETS ]
+        shape = hdf[names[0]].shape
+        corner = [ rng.integers(max(s - crop, 0) + 1) for s in shape ]
+        window = tuple(slice(c, c + crop) for c in corner)
+        for name in names:
+            nbytes += hdf[name][window].nbytes
+    elapsed = time.perf_counter() - start
+    for hdf in handles:
+        hdf.close()
+    return nb_crops / elapsed, nbytes / elapsed / 1024 ** 2
+
+
+@cli.group(context_settings={"help_option_names": ["-h", "--help"],
+                             "show_default": True})
+def main():
+    """ Rechunk and recompress HDFs for faster random crops """
+
+
+@main.command(context_settings={"show_default": True})
+@cli.argument("pdata", type=cli.Path(exists=True, resolve_path=True, file_okay=False,
+              path_type=Path))
+@cli.argument("pout", type=cli.Path(resolve_path=True, file_okay=False, path_type=Path))
+@cli.option("--chunks", "-c", default="32",
+            help="Chunk shape, one size for all dimensions, comma separated sizes, or 'none'.")
+@cli.option("--codec", type=cli.Choice(CODECS), default="lzf", help="Compression filter.")
+@cli.option("--level", "-l", type=cli.IntRange(0, 9), default=4, help="Gzip level.")
+@cli.option("--workers", "-j", type=cli.IntRange(min=1), default=None, show_default=False,
+            help="Number of processes rewriting HDFs. [default: number of CPUs]")
+def convert(pdata, pout, chunks, codec, level, workers):
+    """
+    Rewrite all HDFs of PDATA in POUT with same structure, but volumes and
+    ground truths stored in CHUNKS compressed with CODEC.\n
+    Rerun `data.preprocess` on POUT if you use metadata.
+
+    PDATA    DIR    Path to directory containing data in HDF format.\n
+    POUT     DIR    Where to write the rewritten HDFs.
+    """
+    chunks = parse_chunks(chunks)
+    _storage((1, 1, 1), chunks, codec, level) # Fail early
+    for fname in rewrite_directory(pdata, pout, chunks, codec, level, workers):
+        print(f"Rewrote {fname.name}")
+
+
+@main.command(context_settings={"show_default": True})
+@cli.argument("pdata", type=cli.Path(exists=True, resolve_path=True, file_okay=False,
+              path_type=Path))
+@cli.option("--chunks", "-c", multiple=True, default=["32", "64"],
+            help="Chunk shapes to try, can be repeated.")
+@cli.option("--codec", multiple=True, type=cli.Choice(CODECS), default=CODECS,
+            help="Codecs to try, can be repeated.")
+@cli.option("--level", "-l", type=cli.IntRange(0, 9), default=4, help="Gzip level.")
+@cli.option("--crop", type=cli.IntRange(min=1), default=128, help="Size of random crops.")
+@cli.option("--nb-crops", "-n", type=cli.IntRange(min=1), default=50,
+            help="Number of crops read per layout.")
+@cli.option("--files", "-f", "limit", type=cli.IntRange(min=1), default=4,
+            help="Number of HDFs of PDATA used.")
+@cli.option("--tmpdir", type=cli.Path(file_okay=False, path_type=Path), default=None,
+            show_default=False, help="Where to write trial HDFs, use the disk you train from.")
+def benchmark(pdata, chunks, codec, level, crop, nb_crops, limit, tmpdir):
+    """
+    Read random crops from the HDFs of PDATA as they are, then rewritten with
+    each combination of CHUNKS and CODEC, and report throughput.\n
+    Files are read right after being written, so they're probably in the page
+    cache; compare layouts with each other rather than with your epoch time.
+
+    PDATA    DIR    Path to directory containing data in HDF format.
+    """
+    fnames = sorted(f for f in pdata.iterdir() if f.suffix == ".h5")[:limit]
+    rows = [ ("original", "-", sum(f.stat().st_size for f in fnames),
+              *benchmark_crops(fnames, crop, nb_crops)) ]
+    if tmpdir is not None:
+        tmpdir.mkdir(parents=True, exist_ok=True)
+    for ck, cd in product(chunks, codec):
+        try:
+            _storage((1, 1, 1), parse_chunks(ck), cd, level)
+        except ValueError:
+            continue # Contiguous and compressed, not possible
+        with TemporaryDirectory(dir=tmpdir) as ptmp:
+            written = rewrite_directory(pdata, ptmp, parse_chunks(ck), cd, level, limit=limit)
+            rows.append((ck, f"gzip-{level}" if cd == "gzip" else cd,
+                         sum(f.stat().st_size for f in written),
+                         *benchmark_crops(written, crop, nb_crops)))
+    print(f"{'chunks':>10} {'codec':>8} {'size (MB)':>10} {'crops/s':>8} {'MB/s':>8}")
+    for ck, cd, size, crops, mbs in rows:
+        print(f"{ck:>10} {cd:>8} {size / 1024 ** 2:>10.1f} {crops:>8.1f} {mbs:>8.1f}")
+
+
+
+if __name__ == "__main__":
+    main()
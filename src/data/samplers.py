@@ -0,0 +1,132 @@
+"""
+Samplers whose order can be recomputed anywhere, e.g. by DataLoader workers
+reading ahead (see `data.prefetch`)
+"""
+
+import ctypes
+import multiprocessing as mp
+import torch
+import torch.distributed as dist
+
+from itertools import cycle, islice
+from math import ceil
+from torch.utils.data import Sampler
+
+
+
+class PlannedSampler(Sampler):
+    """
+    Order of an epoch only depends on `seed` and the epoch number, so whoever
+    holds the sampler knows the whole epoch in advance. The epoch is shared
+    with DataLoader workers, update it with `set_epoch` (Lightning does).
+    """
+    def __init__(self, data_source, shuffle=True, seed=None):
+        self.size = len(data_source)
+        self.shuffle = shuffle
+        # Drawn from torch's RNG so `seed_everything` still applies
+        self.seed = int(torch.empty((), dtype=torch.int64).random_().item()) if seed is None\
+                        else seed
+        self._epoch = mp.RawValue(ctypes.c_long, 0)
+
+    @property
+    def epoch(self):
+        return self._epoch.value
+
+    def set_epoch(self, epoch):
+        self._epoch.value = epoch
+
+    def plan(self, epoch=None):
+        """ Indexes in the order they'll be yielded during `epoch` """
+        epoch = self.epoch if epoch is None else epoch
+        if not self.shuffle:
+            return list(range(self.size))
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        return torch.randperm(self.size, generator=generator).tolist()
+
+    def __iter__(self):
+        return iter(self.plan())
+
+    def __len__(self):
+        return self.size
+
+
+class FileLocalitySampler(PlannedSampler):
+    """
+    Shuffle sequences, then emit their frames in shuffled blocks of `block_size`
+    frames of the same file, so consecutive reads keep hitting the same HDFs.
+    Blocks are mixed within windows of `window` sequences (all of them if None),
+    so at most that many files are in use at once. `block_size=1` and
+    `window=None` is a plain shuffle, the larger they are the more local reads.
+    With several processes, blocks are dealt between ranks, which then need the
+    same `seed` (0 by default). Set `replace_sampler_ddp: False` in Lightning's
+    trainer so it keeps this sampler.
+    """
+    def __init__(self, data_source, shuffle=True, seed=None, block_size=8, window=None,
+                 num_replicas=None, rank=None):
+        distributed = dist.is_available() and dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if distributed else 1
+        if rank is None:
+            rank = dist.get_rank() if distributed else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank}, should be in [0, {num_replicas - 1}].")
+        if seed is None and num_replicas > 1:
+            seed = 0 # Ranks must agree on the order
+        super(FileLocalitySampler, self).__init__(data_source, shuffle, seed)
+        self.block_size = block_size
+        self.window = window
+        self.num_replicas, self.rank = num_replicas, rank
+        self.sequences = self._group(data_source)
+
+    def _group(self, data_source):
+        # Dataset's indexes per sequence, so blocks never mix files
+        sequence_indexes = getattr(data_source, "sequence_indexes", None)
+        if sequence_indexes is None or len(sequence_indexes) != len(data_source):
+            # One sample per sequence (e.g. `FrameDataset`), nothing to group
+            return [ [i] for i in range(len(data_source)) ]
+        sequences = {}
+        for i, iseq in enumerate(sequence_indexes):
+            sequences.setdefault(iseq, []).append(i)
+        return list(sequences.values())
+
+    def _order(self, n, generator):
+        if not self.shuffle:
+            return list(range(n))
+        return torch.randperm(n, generator=generator).tolist()
+
+    def plan(self, epoch=None):
+        epoch = self.epoch if epoch is None else epoch
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        sequences = [ self.sequences[k] for k in self._order(len(self.sequences), generator) ]
+        window = self.window or len(sequences)
+        blocks = []
+        for start in range(0, len(sequences), window):
+            wblocks = []
+            for frames in sequences[start:start + window]:
+                frames = [ frames[k] for k in self._order(len(frames), generator) ]
+                wblocks += [ frames[k:k + self.block_size]
+                                for k in range(0, len(frames), self.block_size) ]
+            blocks += [ wblocks[k] for k in self._order(len(wblocks), generator) ]
+        return self._shard(blocks)
+
+    def _shard(self, blocks):
+        order = [ i for block in blocks for i in block ]
+        if self.num_replicas == 1:
+            return order
+        # Give next block to the rank with less samples, so shares are balanced.
+        # Blocks are split when they'd give a rank more than its `len(self)`
+        shares = [ [] for _ in range(self.num_replicas) ]
+        for block in blocks:
+            while block:
+                share = min(shares, key=len)
+                room = len(self) - len(share)
+                share.extend(block[:room])
+                block = block[room:]
+        share = shares[self.rank]
+        # All ranks must yield as many samples, pad with samples seen elsewhere
+        return share + list(islice(cycle(order), len(self) - len(share)))
+
+    def __len__(self):
+        return ceil(self.size / self.num_replicas)
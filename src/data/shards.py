@@ -0,0 +1,137 @@
+"""
+Pack the sets of a data split into large tar shards read sequentially by
+`data.datasets.ShardDataset`, for storage where random reads are slow (e.g.
+network file systems). Run as `python -m data.shards`.
+"""
+
+import click as cli
+import h5py
+import io
+import json
+import numpy as np
+import random as rd
+import tarfile
+import yaml
+
+from pathlib import Path
+
+from data.cache import to_bytes
+from data.hdf import LEAFLETS, ReadBuffers, read_labels, read_volume
+
+
+
+INDEX = "index.json"
+SETS = ["train", "validation", "test"]
+# Members of each sample, in this order
+INPUT, LABEL = "input.npy", "label.npy"
+
+
+
+def load_shard_index(pshards):
+    with open(Path(pshards).joinpath(INDEX), 'r') as fd:
+        return json.load(fd)
+
+def _read_npy(fd):
+    # `np.load` wants actual files, read `np.save` output straight into an array instead
+    version = np.lib.format.read_magic(fd)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+                    else np.lib.format.read_array_header_2_0
+    shape, _, dtype = read_header(fd) # Always written in C order
+    array = np.empty(shape, dtype)
+    fd.readinto(memoryview(array).cast('B'))
+    return array
+
+def read_samples(path, buffering=8 * 1024 ** 2):
+    """ Yield (key, input, label) of a shard, reading it from start to end """
+    with open(path, 'rb', buffering=buffering) as fd, tarfile.open(fileobj=fd, mode="r|") as tar:
+        sample = {}
+        for member in tar:
+            key, kind = member.name.split('/', 1)
+            sample[kind] = _read_npy(tar.extractfile(member))
+            if len(sample) == 2:
+                yield key, sample[INPUT], sample[LABEL]
+                sample = {}
+
+
+def _add(tar, name, array):
+    buf = io.BytesIO()
+    np.save(buf, array)
+    info = tarfile.TarInfo(name)
+    info.size = buf.tell()
+    buf.seek(0)
+    tar.addfile(info, buf)
+
+def _frames(pdata, files):
+    # (key, input, packed labels) of all frames of all files
+    buffers = ReadBuffers()
+    for fname, nbf in files:
+        with h5py.File(pdata.joinpath(fname), 'r') as hdf:
+            for iframe in range(1, nbf + 1):
+                vin = read_volume(hdf["CartesianVolume"][f"vol{iframe:02d}"])
+                label = read_labels(hdf["GroundTruth"][f"anterior-{iframe:02d}"],
+                                    hdf["GroundTruth"][f"posterior-{iframe:02d}"], buffers)
+                yield f"{fname}-{iframe - 1:02d}", vin, label
+
+def pack_set(pdata, files, pshards, name, shard_size):
+    """ Write frames of `files` in shards of about `shard_size` bytes, return their index """
+    shards, tar = [], None
+    for key, vin, label in _frames(pdata, files):
+        if tar is None or tar.offset >= shard_size:
+            if tar is not None:
+                tar.close()
+            shards.append({"shard": f"{name}-{len(shards):05d}.tar", "samples": []})
+            tar = tarfile.open(pshards.joinpath(shards[-1]["shard"]), 'w')
+        # Offset of sample's first header, for random access if ever needed
+        shards[-1]["samples"].append({"key": key, "offset": tar.offset, "shape": list(vin.shape)})
+        _add(tar, f"{key}/{INPUT}", vin)
+        _add(tar, f"{key}/{LABEL}", label)
+    if tar is not None:
+        tar.close()
+    return shards
+
+
+@cli.group(context_settings={"help_option_names": ["-h", "--help"],
+                             "show_default": True})
+def main():
+    """ Pack data splits into shards for sequential reads """
+
+
+@main.command(context_settings={"show_default": True})
+@cli.argument("pdata", type=cli.Path(exists=True, resolve_path=True, file_okay=False,
+              path_type=Path))
+@cli.argument("split", type=cli.Path(exists=True, dir_okay=False, path_type=Path))
+@cli.argument("pshards", type=cli.Path(resolve_path=True, file_okay=False, path_type=Path))
+@cli.option("--shard-size", "-s", default="1G", help="Size of each shard, e.g. 512M, 2G.")
+@cli.option("--shuffle/--no-shuffle", default=True,
+            help="Shuffle sequences before packing, so shards mix acquisitions.")
+@cli.option("--seed", type=int, default=42, help="Seed of the shuffle.")
+def pack(pdata, split, pshards, shard_size, shuffle, seed):
+    """
+    Write all frames of each set of SPLIT (raw inputs and packed leaflets'
+    labels) in tar shards, plus an index of their samples.\n
+    Use it with the `ShardDataset` by giving PSHARDS as `prefix`.
+
+    PDATA      DIR     Path to directory containing data in HDF format.\n
+    SPLIT      FILE    Data split, as written by `data.preprocess`.\n
+    PSHARDS    DIR     Where to write the shards.
+    """
+    with open(split, 'r') as fd:
+        split = yaml.safe_load(fd)
+    pshards.mkdir(parents=True, exist_ok=True)
+    rng = rd.Random(seed)
+    index = {"labels": LEAFLETS, "sets": {}}
+    for name in SETS:
+        files = list(split.get(name, {}).get("files", []))
+        if shuffle:
+            rng.shuffle(files)
+        index["sets"][name] = pack_set(pdata, files, pshards, name, to_bytes(shard_size))
+        nb = sum(len(s["samples"]) for s in index["sets"][name])
+        print(f"Packed {nb} frames of {name} set in {len(index['sets'][name])} shard(s)")
+    with open(pshards.joinpath(INDEX), 'w') as fd:
+        json.dump(index, fd)
+    print(f"Shards available at {pshards}")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Generate volumes looking somewhat like echovox's: two thin curved leaflets in
+speckled ultrasound-like intensities. `data.generate` writes them as HDFs.
+"""
+
+import torch
+import torch.nn.functional as F
+
+from data.transforms import decode_labels, encode_labels
+
+
+
+def _grid(spatial_size):
+    # Voxel coordinates in [-1, 1], (3, W, H, D)
+    axes = [ torch.linspace(-1, 1, s) for s in spatial_size ]
+    return torch.stack(torch.meshgrid(*axes, indexing="ij"))
+
+def _uniform(generator, low, high, size=()):
+    return low + (high - low) * torch.rand(size, generator=generator)
+
+def leaflet_masks(generator, spatial_size):
+    """
+    Anterior and posterior leaflets as boolean (W, H, D) masks: caps of
+    spherical shells on both sides of the valve's axis, meeting around its
+    middle like a closed valve
+    """
+    grid = _grid(spatial_size)
+    # Valve's center and axis (mostly along last dimension), tilted a bit
+    center = _uniform(generator, -0.15, 0.15, (3,))
+    axis = torch.tensor([0., 0., 1.]) + _uniform(generator, -0.3, 0.3, (3,))
+    axis = axis / axis.norm()
+    side = torch.cross(axis, torch.tensor([1., 0., 0.]), dim=0)
+    side = side / side.norm()
+    rel = grid - center.view(3, 1, 1, 1)
+    along = (rel * axis.view(3, 1, 1, 1)).sum(0)
+    across = (rel * side.view(3, 1, 1, 1)).sum(0)
+    radial = (rel - along * axis.view(3, 1, 1, 1)).norm(dim=0)
+    annulus = _uniform(generator, 0.35, 0.55) # Valve's radius
+    thickness = _uniform(generator, 0.02, 0.04)
+    masks = []
+    for sign, length in ((1, _uniform(generator, 0.55, 0.75)), (-1, _uniform(generator, 0.35, 0.5))):
+        # Shell centered away from the leaflet, so it bulges toward the atrium
+        radius = _uniform(generator, 0.8, 1.2)
+        shell_center = center - sign * side * (radius - length * annulus) + axis * 0.1
+        dist = (grid - shell_center.view(3, 1, 1, 1)).norm(dim=0)
+        shell = (dist - radius).abs() < thickness
+        masks.append(shell & (sign * across > 0) & (radial < annulus) & (along.abs() < 0.3))
+    return masks[0], masks[1]
+
+def speckle(generator, masks, spatial_size, smooth=1):
+    """ Ultrasound-like intensities in [0, 1], bright tissue on dark blood, Rayleigh speckle """
+    grid = _grid(spatial_size)
+    tissue = torch.zeros(spatial_size)
+    for mask in masks:
+        tissue = torch.maximum(tissue, mask.to(torch.float))
+    # Some walls far from the valve, and intensity decreasing with depth
+    walls = (grid.norm(dim=0) - _uniform(generator, 0.85, 0.95)).abs() < 0.05
+    tissue = torch.maximum(tissue, walls.to(torch.float) * 0.6)
+    depth = 1 - 0.4 * (grid[-1] + 1) / 2
+    sigma = (0.08 + 0.5 * tissue) * depth
+    rayleigh = torch.sqrt(-2 * torch.log(1 - torch.rand(spatial_size, generator=generator)))
+    vin = (sigma * rayleigh).view(1, 1, *spatial_size)
+    for _ in range(smooth): # Speckle is correlated between neighbours
+        vin = F.avg_pool3d(vin, 3, stride=1, padding=1, count_include_pad=False)
+    # Quantised as echovox's 8 bits volumes, then normalised as `NORMS["256"]` does
+    return torch.round(vin[0].clamp(0, 1) * 255) / 255
+
+def synthetic_sample(generator, spatial_size, multiclass=False):
+    """ (input, one-hot target) as given by `_HDFDataset` """
+    ant, post = leaflet_masks(generator, spatial_size)
+    vin = speckle(generator, (ant, post), spatial_size)
+    return vin, decode_labels(encode_labels(ant, post), multiclass).to(torch.float)
+
+def noise_sample(generator, spatial_size, multiclass=False):
+    """ Uniform input and random (not one-hot) target, cheapest to generate """
+    vin = torch.rand(1, *spatial_size, generator=generator)
+    nc = 3 if multiclass else 2
+    return vin, torch.randint(0, 2, (nc, *spatial_size), generator=generator).to(torch.float)
+
+def burn(vin, iterations):
+    """ Spend compute as decoding would, without changing `vin` """
+    x = vin.view(1, 1, *vin.shape[-3:])
+    for _ in range(iterations):
+        x = F.avg_pool3d(x, 3, stride=1, padding=1)
+    return vin
+
+
+
+GENERATORS = {"noise": noise_sample, "leaflets": synthetic_sample}
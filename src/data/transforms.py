@@ -1,52 +1,184 @@
 import monai.transforms as mt
+import numpy as np
+import torch
 
 from monai.utils import Method, PytorchPadMode
 
+from data.hdf import LEAFLETS
+from utils import TensorList
+
 
 
 
 NORMS = {"256": mt.NormalizeIntensity(subtrahend=0, divisor=255),
          "std": mt.NormalizeIntensity()}
-
+# Set on actual voxels of label maps in compact transport, padding won't have it
+INSIDE = 2 * max(LEAFLETS.values())
+
+
+
+def encode_labels(ant, post):
+    """ Pack both leaflets' masks in one uint8 label map, one bit per leaflet """
+    return (ant != 0).to(torch.uint8) * LEAFLETS["anterior"] \
+            | (post != 0).to(torch.uint8) * LEAFLETS["posterior"]
+
+def decode_labels(label, multiclass=False, dim=0):
+    """ Expand label map from `encode_labels` to one-hot booleans, classes along `dim` """
+    ant, post = (label & LEAFLETS["anterior"]) != 0, (label & LEAFLETS["posterior"]) != 0
+    if multiclass:
+        #FIXME: Some voxel are in both ant & post class
+        none = ~(ant | post)
+        return torch.stack([none, ant, post], dim=dim)
+    leaflet = (ant | post)
+    # This way is easier to handle both multiclass and binary class
+    return torch.stack([~leaflet, leaflet], dim=dim)
+
+def intensity_stats(vin, norm="256", contrast=None):
+    """
+    Values normalisation and contrast take from the whole raw volume, so
+    `expand_batch` can give the same result on a crop: (subtrahend, divisor,
+    min and range of normalised volume)
+    """
+    norm = NORMS[norm]
+    x = vin.to(torch.float32).flatten()
+    sub = norm.subtrahend if norm.subtrahend is not None else x.mean()
+    div = norm.divisor if norm.divisor is not None else x.std(unbiased=False)
+    div = div if div != 0 else 1.
+    vmin, vmax = (torch.stack([x.min(), x.max()]) - sub) / div
+    return torch.tensor([sub, div, vmin, vmax - vmin], dtype=torch.float32)
+
+def expand_batch(inputs, labels, stats, norm="256", contrast=None, multiclass=False,
+                 as_list=False, inside_bit=False):
+    """
+    Batched `_HDFDataset.expand_volumes`, receive (B, 1, W, H, D) raw inputs and
+    label maps, and (B, 4) `intensity_stats`. With `inside_bit`, voxels without
+    `INSIDE` are padding and set to zero, as padding dense volumes would
+    """
+    # Each is (B, 1, 1, 1, 1) to broadcast with inputs
+    sub, div, vmin, vrange = stats.to(torch.float32).view(-1, 4, 1, 1, 1, 1).unbind(1)
+    vin = (inputs.to(torch.float32) - sub) / div
+    if contrast is not None: # Same as `mt.AdjustContrast`
+        vin = ((vin - vmin) / (vrange + 1e-7)) ** contrast * vrange + vmin
+    vout = decode_labels(labels[:,0], multiclass, dim=1)
+    if inside_bit:
+        inside = (labels & INSIDE) != 0
+        vin, vout = vin * inside, vout & inside
+    if as_list:
+        # 1st element of vout is just background, don't keep it
+        vout = [ torch.stack([~vout[:,k], vout[:,k]], dim=1).to(torch.float)
+                    for k in range(1, vout.shape[1]) ]
+        # Same nesting as the one Lightning gives to TensorList when transferring them
+        return vin, TensorList(vout)
+    return vin, vout.to(torch.float)
+
+
+
+def augmentations(keys):
+    """ Random transforms of (input, target) dict `keys` used for training """
+    return mt.Compose([
+        # Move around (input, target)
+        mt.RandRotated(keys, range_x=5, range_y=5, range_z=5),
+        mt.RandAxisFlipd(keys),
+        # Add noise to input
+        mt.RandGaussianNoised(keys[0]),
+        mt.RandGridDistortiond(keys[0]),
+        mt.Rand3DElasticd(keys[0], (5, 7), (50, 150))
+        # And many more...
+    ])
+
+
+def _place(center, roi, size):
+    # Window of `roi` voxels around `center`, moved to fit in [0, size)
+    roi = min(roi, size)
+    start = min(max(int(center) - roi // 2, 0), size - roi)
+    return slice(start, start + roi)
 
 
 class ResizeWithPadOrCropd(mt.ResizeWithPadOrCropd):
+    """
+    Crop a window of (at most) `spatial_size` then pad to `spatial_size`.
+    Subclasses only change where the window is, see `window`.
+    """
     def __init__(self, keys, spatial_size, method=Method.SYMMETRIC,
                  mode=PytorchPadMode.CONSTANT, **pad_kwargs):
         pad_kwargs.pop("multiclass", None) # This is why we overwrite
+        indices_key = pad_kwargs.pop("indices_key", "indices")
         super(ResizeWithPadOrCropd, self).__init__(
                 keys, spatial_size, method=method, mode=mode, **pad_kwargs)
-
-
-class ResizeWithPadOrRandCropd(mt.ResizeWithPadOrCropd):
-    def __init__(self, keys, spatial_size, method=Method.SYMMETRIC,
-                 mode=PytorchPadMode.CONSTANT, **pad_kwargs):
-        pad_kwargs.pop("multiclass", None)
-        super(ResizeWithPadOrRandCropd, self).__init__(
-                keys, spatial_size, method=method, mode=mode, **pad_kwargs)
-        # Overwrite cropper
-        self.cropper = mt.RandSpatialCropd(keys, roi_size=spatial_size, random_center=False)
-
-class ResizeWithPadOrCenterRandCropd(mt.ResizeWithPadOrCropd):
-    def __init__(self, keys, spatial_size, method=Method.SYMMETRIC,
-                 mode=PytorchPadMode.CONSTANT, **pad_kwargs):
-        pad_kwargs.pop("multiclass", None)
-        super(ResizeWithPadOrCenterRandCropd, self).__init__(
-                keys, spatial_size, method=method, mode=mode, **pad_kwargs)
-        # Overwrite cropper
-        self.cropper = mt.RandSpatialCropd(keys, roi_size=spatial_size)
-
-class ResizeWithPadOrRandCropByLabelClassesd(mt.ResizeWithPadOrCropd):
+        self.spatial_size = spatial_size
+        self.indices_key = indices_key
+
+    def window(self, shape, label=None, bboxes=None, indices=None):
+        """
+        Slices of a volume of spatial `shape` to keep, so they can be read
+        alone. `label` (one-hot), leaflets' `bboxes` or foreground `indices`
+        (see `data.indices`) are only needed by crops following classes.
+        """
+        return tuple(_place(s // 2, roi, s) for s, roi in zip(shape, self.spatial_size))
+
+    def __call__(self, data):
+        d = dict(data)
+        slices = self.window(d[self.keys[0]].shape[1:], label=d.get(self.keys[-1]),
+                             indices=d.get(self.indices_key))
+        for key, m in self.key_iterator(d, self.mode):
+            # Window fits in `spatial_size`, so this only pads
+            d[key] = self.padder(d[key][(slice(None), *slices)], mode=m)
+        return d
+
+
+class ResizeWithPadOrRandCropd(ResizeWithPadOrCropd):
+    # Window anywhere in the volume
+    def window(self, shape, label=None, bboxes=None, indices=None):
+        return tuple(_place(torch.randint(min(roi, s) // 2, s - (min(roi, s) - 1) // 2, ()), roi, s)
+                        for s, roi in zip(shape, self.spatial_size))
+
+class ResizeWithPadOrCenterRandCropd(ResizeWithPadOrCropd):
+    # Center of a random box at least as big as the window, so it's more often around the center
+    def window(self, shape, label=None, bboxes=None, indices=None):
+        slices = []
+        for s, roi in zip(shape, self.spatial_size):
+            box = int(torch.randint(min(roi, s), s + 1, ()))
+            start = int(torch.randint(0, s - box + 1, ()))
+            slices.append(_place(start + box // 2, roi, s))
+        return tuple(slices)
+
+class ResizeWithPadOrRandCropByLabelClassesd(ResizeWithPadOrCropd):
     def __init__(self, keys, spatial_size, multiclass=False, method=Method.SYMMETRIC,
                  mode=PytorchPadMode.CONSTANT, **pad_kwargs):
         # Ensure crop is centered around a leaflet voxel
-        ratio = [0, 1, 1] if multiclass else [0, 1]
-        pad_kwargs.pop("multiclass", None)
+        self.ratio = [0, 1, 1] if multiclass else [0, 1]
         super(ResizeWithPadOrRandCropByLabelClassesd, self).__init__(
                 keys, spatial_size, method=method, mode=mode, **pad_kwargs)
-        # Overwrite cropper
-        self.cropper = mt.RandCropByLabelClassesd(keys, keys[-1], spatial_size,
-                                                  ratios=ratio, num_samples=len(ratio))
+
+    def window(self, shape, label=None, bboxes=None, indices=None):
+        """
+        Centered on a voxel of a class drawn following `ratio`, taken from
+        foreground `indices`, `label`, or uniformly in the class' bounding box
+        from `bboxes` (one per class but background, None if empty)
+        """
+        if indices is not None: # Cheapest, no need to look at the volume
+            found = [ indices[l] for l in LEAFLETS ] if len(self.ratio) > 2 else [ indices["any"] ]
+            found = [ f if len(f) else None for f in found ]
+        elif bboxes is not None:
+            found = bboxes
+        elif label is not None:
+            found = [ label[k] != 0 for k in range(1, len(self.ratio)) ]
+            found = [ f if f.any() else None for f in found ]
+        else:
+            raise ValueError("Cropping by classes needs the label, leaflets' bounding boxes or foreground indices.")
+        ratio = torch.tensor([ r if f is not None else 0 for r, f in zip(self.ratio[1:], found) ],
+                             dtype=torch.float)
+        if ratio.sum() == 0: # No leaflet to center on
+            return super().window(shape)
+        cls = found[int(torch.multinomial(ratio, 1))]
+        if indices is not None:
+            center = np.unravel_index(int(cls[torch.randint(len(cls), ())]), tuple(shape))
+        elif bboxes is not None:
+            center = [ int(torch.randint(lo, hi + 1, ())) for lo, hi in zip(*cls) ]
+        else:
+            voxels = cls.nonzero()
+            center = voxels[torch.randint(len(voxels), ())].tolist()
+        return tuple(_place(c, roi, s) for c, roi, s in zip(center, self.spatial_size, shape))
 
 
 
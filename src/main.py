@@ -11,6 +11,7 @@ from pytorch_lightning.utilities.seed import seed_everything
 
 from callbacks import *
 from data import load_data
+from data.datasets import HDFStreamDataset, ShardDataset
 from networks import build_model
 from utils import InclusiveLoader, rec_update
 
@@ -82,6 +83,10 @@ def test(ctx, eval_net, predict):
     cdata = config["data"]
     dataset_name = cdata["dataset"].pop("name")
     teloader = load_data(dataset_name, test=True, **cdata)
+    if predict and isinstance(teloader.dataset, ShardDataset):
+        # Shards only hold frames, not which file they are from nor its geometry
+        raise ValueError("Predictions can't be saved from shards, use the HDFs they were "
+                         "packed from (e.g. with `HDFStreamDataset`) with --predict.")
     print("Building network...")
     cnet = config["network"]
     if not "weights" in cnet:
@@ -98,7 +103,9 @@ def test(ctx, eval_net, predict):
     wandblog = WandbLogger(**kwwandb, name=wandb.run.name, save_dir=str(logdir))
     # Save full testing config (before testing in case of crash)
     wandblog.experiment.config.update(ctx.obj["config"])
-    callbacks = [SavePredictedSequence()]
+    # Streams have no sequences to gather, predictions are written batch by batch
+    stream = isinstance(teloader.dataset, HDFStreamDataset)
+    callbacks = [StreamPredictionWriter() if stream else SavePredictedSequence()]
     if "Frame" in dataset_name:
         callbacks.extend([Plot3D(), SlicePlot(), SlicePlot(axis=1),
                           SliceVolumePlot(), SliceVolumePlot(axis=1)])
@@ -114,7 +121,7 @@ def test(ctx, eval_net, predict):
         # NB: Callbacks are only called with --predict
         tester.test(net, teloader)
     if predict:
-        tester.predict(net, teloader)
+        tester.predict(net, teloader, return_predictions=not stream)
 
 
 
@@ -0,0 +1,177 @@
+"""
+Find the largest batch a network trains with under a memory budget on CPU,
+and the gradient accumulation reaching a target effective batch. Run as
+`python -m networks.batch_finder` (from `src/`) and merge the fragment it
+writes in your configuration.
+"""
+
+import click as cli
+import inspect as ispc
+import math
+import multiprocessing as mp
+import resource
+import time
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+import yaml
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from copy import deepcopy
+from pathlib import Path
+
+from data.cache import to_bytes
+from networks import build_model
+from utils import InclusiveLoader, rec_update
+
+
+
+def _target(out):
+    # Random one-hot labels shaped as the network's output
+    classes = torch.randint(out.shape[1], (out.shape[0], *out.shape[2:]))
+    return F.one_hot(classes, out.shape[1]).movedim(-1, 1).to(out.dtype)
+
+def probe(cnet, shape, steps=2):
+    """
+    Peak RSS (bytes) and seconds per step of a process doing `steps` training
+    steps (forward, loss, backward, optimizer step) of the network built from
+    `cnet` on random inputs of `shape`. Several steps so optimizer's state is
+    allocated when measuring.
+    """
+    cnet = deepcopy(cnet)
+    copt = cnet.pop("optimizer")
+    net = build_model(cnet.pop("name"), cnet.pop("loss"), dict(copt), **cnet)
+    # Same as `configure_optimizers`, whose scheduler needs a trainer
+    optims = dict(ispc.getmembers(optim, ispc.isclass))
+    opt = optims[copt.pop("name")](net.parameters(), **copt)
+    net.train()
+    x = torch.rand(shape)
+    start = time.perf_counter()
+    for _ in range(steps):
+        out = net(x)
+        if isinstance(out, (list, tuple)): # `ListOutputModule` stacks outputs on batch dim
+            out = torch.cat(list(out), dim=0)
+        loss = net.loss(out, _target(out)).mean()
+        opt.zero_grad()
+        loss.backward()
+        opt.step()
+    elapsed = (time.perf_counter() - start) / steps
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, elapsed
+
+def _is_oom(err):
+    return isinstance(err, (MemoryError, BrokenProcessPool)) or \
+           (isinstance(err, RuntimeError) and "allocate" in str(err))
+
+def _isolated(cnet, shape, steps):
+    # Fresh process each time, its peak is the probe's only. Killed by the
+    # system or failing to allocate means it doesn't fit
+    with ProcessPoolExecutor(1, mp_context=mp.get_context("spawn")) as pool:
+        try:
+            return pool.submit(probe, cnet, shape, steps).result()
+        except Exception as err:
+            if _is_oom(err):
+                return None, None
+            raise
+
+
+def find_batch(cnet, sample_shape, budget, max_batch, crops=1, steps=2, margin=1.25):
+    """
+    Largest batch size (at most `max_batch`) whose training step stays under
+    `budget` bytes, each batch holding `crops` samples per element. Doubles
+    the batch until it doesn't fit, then bisects. Batches whose RSS,
+    extrapolated linearly from the last probes, is over `margin` times the
+    budget are deemed too large without running them.
+    """
+    probes = {}
+    def fits(batch):
+        if batch not in probes:
+            known = sorted((b, r) for b, (r, _) in probes.items() if r is not None)
+            if len(known) >= 2:
+                (b0, r0), (b1, r1) = known[-2:]
+                if r1 + (batch - b1) * (r1 - r0) / (b1 - b0) > margin * budget:
+                    print(f"Batch {batch}: skipped, extrapolated over budget")
+                    probes[batch] = (None, None)
+                    return False
+            shape = (batch * crops, *sample_shape)
+            probes[batch] = _isolated(cnet, shape, steps)
+            rss, elapsed = probes[batch]
+            if rss is None:
+                print(f"Batch {batch}: out of memory")
+            else:
+                print(f"Batch {batch}: peak RSS {rss / 1024 ** 3:.2f}G, "
+                      f"{elapsed:.2f}s per step ({batch * crops / elapsed:.2f} samples/s)")
+        rss = probes[batch][0]
+        return rss is not None and rss <= budget
+    if not fits(1):
+        return 0, probes
+    lo, hi = 1, None # `lo` fits, `hi` doesn't
+    while hi is None and lo < max_batch:
+        nxt = min(2 * lo, max_batch)
+        if fits(nxt):
+            lo = nxt
+        else:
+            hi = nxt
+    while hi is not None and hi - lo > 1:
+        mid = (lo + hi) // 2
+        lo, hi = (mid, hi) if fits(mid) else (lo, mid)
+    return lo, probes
+
+def accumulation(batch, target):
+    """ (batch size, accumulated batches) reaching at least `target` with batches up to `batch` """
+    accumulate = math.ceil(target / batch)
+    return math.ceil(target / accumulate), accumulate
+
+
+
+@cli.command(context_settings={"help_option_names": ["-h", "--help"],
+                               "show_default": True})
+@cli.option("-c", "--config-file", type=cli.Path(exists=True), default=None,
+            help="YML of the training, over `default-train.yml`.")
+@cli.option("--budget", "-m", required=True, help="Memory a training step may use, e.g. 16G.")
+@cli.option("--target", "-t", type=cli.IntRange(min=1), default=None,
+            help="Effective batch size to reach. [default: configuration's `batch_size`]")
+@cli.option("--spatial-size", "-s", default=None,
+            help="Comma separated input size. [default: dataset's `spatial_size`]")
+@cli.option("--max-batch", "-b", type=cli.IntRange(min=1), default=None,
+            help="Largest batch to try. [default: target]")
+@cli.option("--steps", type=cli.IntRange(min=2), default=2, help="Training steps per probe.")
+@cli.option("--output", "-o", "ofname", type=cli.Path(dir_okay=False, path_type=Path),
+            default="batch.yml", help="Where to write the batch settings.")
+def main(config_file, budget, target, spatial_size, max_batch, steps, ofname):
+    """
+    Train the configured network for a few steps on random inputs with
+    growing batches, each in a new process, and write the largest batch
+    fitting BUDGET with the gradient accumulation reaching the target batch
+    as a YAML fragment to merge in the training configuration.\n
+    Only the training process is measured, add what DataLoader workers use.
+    """
+    with open("../config/default-train.yml", 'r') as fd:
+        config = yaml.load(fd, InclusiveLoader)
+    if config_file:
+        with open(config_file, 'r') as fd:
+            config = rec_update(config, yaml.load(fd, InclusiveLoader))
+    cnet, cdata = config["network"], config["data"]
+    target = target or cdata.get("batch_size", 1)
+    if spatial_size is None:
+        spatial_size = cdata["dataset"].get("spatial_size", [128, 128, 128])
+    else:
+        spatial_size = [ int(s) for s in spatial_size.split(',') ]
+    sample_shape = (cnet.get("in_channels", 1), *spatial_size)
+    crops = cdata["dataset"].get("crops_per_volume", 1)
+    batch, _ = find_batch(cnet, sample_shape, to_bytes(budget), max_batch or target,
+                          crops, steps)
+    if batch == 0:
+        raise MemoryError(f"Not even a batch of 1 fits in {budget}.")
+    batch_size, accumulate = accumulation(batch, target)
+    fragment = {"data": {"batch_size": batch_size},
+                "trainer": {"accumulate_grad_batches": accumulate}}
+    with open(ofname, 'w') as fd:
+        yaml.dump(fragment, fd, default_flow_style=False)
+    print(f"Largest batch fitting: {batch}. Batches of {batch_size} accumulated over "
+          f"{accumulate} step(s), effective batch {batch_size * accumulate}, available at {ofname}")
+
+
+
+if __name__ == "__main__":
+    main()
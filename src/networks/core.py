@@ -6,6 +6,7 @@ import torch.nn as nn
 import torch.optim as optim
 import torchmetrics
 
+from data.collates import CompactBatch
 from data.postprocess import grey_morphology, MORPHOLOGIES
 from metrics import MONAI_METRICS
 from utils import LinearCosineLR, TensorList
@@ -118,8 +119,23 @@ class EnhancedLightningModule(pl.LightningModule):
         return {name: errs}
 
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if isinstance(batch, CompactBatch): # Dataset used compact transport
+            return batch.expand()
+        return batch
+
+
+    def _split_batch(self, batch):
+        # Streamed batches (see `data.datasets.streaming`) end with metadata, maybe without target
+        if isinstance(batch[-1], list) and len(batch[-1]) and isinstance(batch[-1][0], dict):
+            return batch[0], batch[1] if len(batch) == 3 else None, batch[-1]
+        return batch[0], batch[1], None
+
+    def _predict(self, x):
+        return self.final_activation(self.forward(x))
+
     def _step(self, batch, batch_idx):
-        x, y = batch
+        x, y, _ = self._split_batch(batch)
         out = self.forward(x)
         # Softmax is baked in `nn.CrossEntropyLoss`, only do it for preds
         sout = self.final_activation(out)
@@ -135,33 +151,35 @@ class EnhancedLightningModule(pl.LightningModule):
 
 
     def training_step(self, batch, batch_idx):
-        _, y = batch
+        _, y, _ = self._split_batch(batch)
         preds, errs = self._step(batch, batch_idx)
         outs = self._log_errs(errs, on_step=True)
         outs.update({"preds": preds, "target": y})
         return outs
 
     def validation_step(self, batch, batch_idx):
-        _, y = batch
+        _, y, _ = self._split_batch(batch)
         preds, errs = self._step(batch, batch_idx)
         outs = self._log_errs(errs, name="v_loss")
         outs.update({"preds": preds, "target": y})
         return outs
 
     def test_step(self, batch, batch_idx):
-        _, y = batch
+        _, y, _ = self._split_batch(batch)
         preds, errs = self._step(batch, batch_idx)
         outs = self._log_errs(errs, on_step=True, on_epoch=False)
         outs.update({"preds": preds, "target": y})
         return outs
 
     def predict_step(self, batch, batch_idx, dataloader_idx=None):
-        _, y = batch
-        preds, _ = self._step(batch, batch_idx)
+        # No need for target nor loss here
+        x, _, meta = self._split_batch(batch)
+        preds = self._predict(x)
         if self.postprocess is not None:
             # Shape is (B, C, W, H, D)
             preds = self.do_postprocess(preds)
-        return preds
+        # Streamed data, give metadata along so predictions can be written
+        return preds if meta is None else (preds, meta)
 
 
     def training_step_end(self, outs):
@@ -232,8 +250,11 @@ class ListOutputModule(EnhancedLightningModule):
                     self.metrics[mode].update({display_name: metric})
 
     # *_step and *_step_end are the same as mother class
+    def _predict(self, x):
+        return TensorList(*map(self.final_activation, self.forward(x)))
+
     def _step(self, batch, batch_idx):
-        x, ys = batch
+        x, ys, _ = self._split_batch(batch)
         outs = self.forward(x) # Return `nn.TensorList`
         # Softmax is baked in `nn.CrossEntropy`, only do it for preds
         souts = TensorList(*map(self.final_activation, outs))
@@ -250,13 +271,13 @@ class ListOutputModule(EnhancedLightningModule):
         return outs
 
     def predict_step(self, batch, batch_idx, dataloader_idx=None):
-        _, y = batch
-        preds, _ = self._step(batch, batch_idx)
+        x, _, meta = self._split_batch(batch)
+        preds = self._predict(x)
         if self.postprocess is not None:
             # Shape is (B, C, W, H, D)
             fmap = lambda x: torch.stack(self.do_postprocess(x))
             preds = TensorList(*map(fmap, preds))
-        return preds
+        return preds if meta is None else (preds, meta)
 
 
     def _update_metrics(self, outs, mode="train"):
@@ -0,0 +1,6 @@
+import sys
+
+from pathlib import Path
+
+# Modules are imported from `src/`, as when running the scripts
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src")))
@@ -0,0 +1,19 @@
+import resource
+import torch
+
+from data.cache import SharedMemoryCache
+
+
+
+def test_shared_cache_holds_more_samples_than_open_files():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limit = 256
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    try:
+        cache = SharedMemoryCache(2 * limit)
+        for i in range(len(cache.keys()), 2 * limit):
+            cache[i] = (torch.full((4,), i), torch.zeros(4, dtype=torch.uint8))
+        assert len(cache) == 2 * limit
+        assert all(int(cache[i][0][0]) == i for i in range(2 * limit))
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
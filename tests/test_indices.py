@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from data.indices import ForegroundIndices
+
+
+
+def _label():
+    return np.array([[0, 1], [2, 3]], dtype=np.uint8)
+
+
+def test_given_signature_is_used_and_saved(tmp_path, monkeypatch):
+    indices = ForegroundIndices(tmp_path)
+    def stat(path):
+        pytest.fail(f"{path} was stat'ed despite its given signature")
+    monkeypatch.setattr(indices, "_signature", stat)
+    indices.get("store/f0.h5", 0, _label, {"size": 10, "mtime": 1.5})
+    with np.load(next(tmp_path.iterdir())) as sidecar:
+        assert (sidecar["size"], sidecar["mtime"]) == (10, 1.5)
+
+
+def test_changed_signature_invalidates_sidecar(tmp_path):
+    computed = []
+    def label():
+        computed.append(True)
+        return _label()
+    signature = {"size": 10, "mtime": 1.5}
+    for _ in range(2): # New instances, so only the sidecar remembers
+        ForegroundIndices(tmp_path).get("store/f0.h5", 0, label, signature)
+    assert len(computed) == 1
+    ForegroundIndices(tmp_path).get("store/f0.h5", 0, label, dict(signature, mtime=2.5))
+    assert len(computed) == 2
@@ -0,0 +1,28 @@
+import pytest
+
+from data.samplers import FileLocalitySampler
+
+
+
+class _Sequences:
+    # Just what samplers look at in a dataset
+    def __init__(self, nb_frames):
+        self.sequence_indexes = [ s for s, nbf in enumerate(nb_frames) for _ in range(nbf) ]
+
+    def __len__(self):
+        return len(self.sequence_indexes)
+
+
+@pytest.mark.parametrize("nb_frames, block_size, num_replicas", [
+    ([8, 2, 3], 8, 3), ([8, 2, 3], 2, 2), ([20, 1, 7, 7], 8, 4), ([5], 8, 3), ([3, 3], 1, 4)])
+@pytest.mark.parametrize("epoch", [0, 1, 2])
+def test_ranks_get_same_length_and_cover_dataset(nb_frames, block_size, num_replicas, epoch):
+    dataset = _Sequences(nb_frames)
+    plans = []
+    for rank in range(num_replicas):
+        sampler = FileLocalitySampler(dataset, block_size=block_size,
+                                      num_replicas=num_replicas, rank=rank)
+        plan = sampler.plan(epoch)
+        assert len(plan) == len(sampler)
+        plans.append(plan)
+    assert set(i for plan in plans for i in plan) == set(range(len(dataset)))